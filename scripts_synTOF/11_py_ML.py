@@ -28,8 +28,22 @@ from sklearn.ensemble import RandomForestClassifier
 
 #### Importing data ------------------------------------------------------------------
 regions = ['BA9', 'DLCau', 'Hipp']
+# if True, compute the feature tables from the fcs files (or their columnar cache) and the metaclusters
+# (utils_features) instead of reading the df_meanAllMarkers csv files of 5_R_postSynaptic_subtraction.R and
+# 6_R_clusterFeatures.R. the tables and the cluster frequencies are written next to the R ones (_py) to compare them
+features_from_events = False
+if features_from_events:
+    from utils_features import region_feature_tables
+    tables, freq_tables = region_feature_tables('R_py_exchange/mcResultsDWH_allGroups_maxK40_allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd_sess_1.csv',
+                                                regions=regions)
+    for region in regions:
+        tables[region].to_csv('R_py_exchange/df_meanAllMarkers_' + region + '_noStd_exp2mc_5_13_py.csv')
+        freq_tables[region].to_csv('R_py_exchange/df_freq_' + region + '_noStd_py.csv')
 for region in regions:
-    df_ = pd.read_csv(''.join(['R_py_exchange/df_meanAllMarkers_', region, '_noStd_exp2mc_5_13.csv'])).iloc[:, 1:]
+    if features_from_events:
+        df_ = tables[region]
+    else:
+        df_ = pd.read_csv(''.join(['R_py_exchange/df_meanAllMarkers_', region, '_noStd_exp2mc_5_13.csv'])).iloc[:, 1:]
     if region == 'BA9':
         df_.columns = df_.columns[0:2].tolist() + [region + '_' + i for i in df_.columns[2:df_.shape[1]].tolist()]
         df = df_
@@ -13,21 +13,27 @@ import random
 from glob import glob
 import flowkit as fk
 import re
+from utils_fcs import read_exchange
 from sklearn.manifold import TSNE as skTSNE
 
 
 # plot clusters ----------------------------------------------------------------------------------------------------
 mc = pd.read_csv('R_py_exchange/mcResultsDWH_allGroups_maxK40_allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd_sess_1.csv')
-mc.loc[:, 'sample'] = mc.loc[:, 'sample'].apply(lambda x: re.sub('_BC\d+', '', x))
+mc['sample'] = mc['sample'].astype('category') # strip the batch once per sample instead of once per event
+mc['sample'] = mc['sample'].cat.rename_categories([re.sub('_BC\d+', '', x) for x in mc['sample'].cat.categories])
 
-hidden_ln = cudf.read_csv('R_py_exchange/hidden_allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd_sess_1.csv').iloc[:, 1:].to_pandas()
-hidden_ln = hidden_ln.loc[hidden_ln.loc[:, 'sample'].apply(lambda x: ('HF14-017.fcs' not in x) & ('HF14-025.fcs' not in x) & ('HF14-083.fcs' not in x)), :]
+hidden_file = 'R_py_exchange/hidden_allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd_sess_1.parquet'
+hidden_ln, samples = read_exchange(hidden_file)
+# sample is an integer code, the sample names are in the lookup table
+samples = samples.set_index('code')['sample']
+odc_codes = samples.index[samples.apply(lambda x: ('HF14-017.fcs' in x) | ('HF14-025.fcs' in x) | ('HF14-083.fcs' in x))]
+hidden_ln = hidden_ln.loc[~hidden_ln.loc[:, 'sample'].isin(odc_codes), :]
 # hidden_lbd = cudf.read_csv('R_py_exchange/hidden_allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd_sess_1_LBD.csv').iloc[:, 1:].to_pandas()
 # hidden_ad = cudf.read_csv('R_py_exchange/hidden_allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd_sess_1_PHAD.csv').iloc[:, 1:].to_pandas()
 # hidden_ = pd.concat([hidden_ln, hidden_lbd, hidden_ad], axis=0).reset_index(drop=True)
 
 hidden_ = hidden_ln
-regions = hidden_.loc[:, 'sample'].apply(lambda x: x.split('_')[0])
+regions = hidden_.loc[:, 'sample'].map(samples.str.split('_').str[0])
 prob = regions.value_counts()/regions.value_counts().max()
 p = regions.map({'BA9': 1/0.67088, 'DLCau': 1/0.52534, 'Hipp': 1})
 
@@ -6,8 +6,7 @@ investigate the robustness of the clusters.
 
 ##%% libraries --------------------------------------------------------------------------------
 # to get reproducible results
-def disabling_blas():
-    n_threads = 1
+def disabling_blas(n_threads=1):
     import os
     os.environ['OMP_NUM_THREADS'] = str(n_threads)
     os.environ['OPENBLAS_NUM_THREADS'] = str(n_threads)
@@ -19,9 +18,14 @@ def disabling_blas():
 disabling_blas()
 
 
-def pretrain(x_train, identifier, dims, i):
+def pretrain(x_train, identifier, dims, i, streamed=False, n_threads=1):
+    # streamed: if True, the shuffled batches are read from x_train through a prefetching tf.data pipeline (see
+    # utils_test.event_dataset) instead of fitting on the array in memory
     # set reproducibility
+    disabling_blas(n_threads)
     import tensorflow as tf
+    from utils_sched import set_tf_threads
+    set_tf_threads(n_threads)
     from glob import glob
     import csv
     import numpy as np
@@ -38,12 +42,9 @@ def pretrain(x_train, identifier, dims, i):
                 tf.config.experimental.set_memory_growth(gpu, True)
         except RuntimeError as e:
             print(e)
-    from importlib import reload
-    disabling_blas()
     seed_value = 42*i
     cb = EarlyStopping(monitor='r_square', min_delta=0.0025, patience=1, \
         verbose=0, mode='max', baseline=None, restore_best_weights=False)   
-    from utils_test import clustering2, clustering3, clustering3_u
     import utils_test
     utils_test.reproducibility(seed_value)
     init = glorot_normal(seed=seed_value)
@@ -54,52 +55,52 @@ def pretrain(x_train, identifier, dims, i):
     opt = tf.keras.optimizers.Adagrad(learning_rate=0.1)
     ae1.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
     ae3.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-    ae1.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
-    ae3.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
+    if streamed:
+        ds = utils_test.event_dataset(x_train, batch_size=2**10, seed=seed_value)
+        steps = utils_test.steps_per_epoch(x_train, batch_size=2**10)
+        ae1.fit(ds, epochs=20000, steps_per_epoch=steps, callbacks=[cb, utils_test.EpochThroughput(x_train.shape[0], 'ae1 rep ' + str(i))])
+        ae3.fit(ds, epochs=20000, steps_per_epoch=steps, callbacks=[cb, utils_test.EpochThroughput(x_train.shape[0], 'ae3 rep ' + str(i))])
+    else:
+        ae1.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
+        ae3.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
     save_dir = '../results_ae'
     ae1.save_weights(save_dir + '/ae1_' + identifier + '_' + str(i) + '.h5')
     ae3.save_weights(save_dir + '/ae3_' + identifier + '_' + str(i) + '.h5')
 
 
 
-def predict(identifier, x_train, i):
-    # set reproducibility
-    import tensorflow as tf
-    import csv
+def predict(identifier, x, rows, i, n_threads=1):
+    # numpy inference from the exported encoders, tensorflow is not needed here
+    # x: the whole cohort, rows: (start, end) ranges of the events to predict (see utils_fcs.row_ranges)
     import numpy as np
-    import random
-    from tensorflow.keras.layers import concatenate
-    from tensorflow.keras.models import Model
-    gpus = tf.config.experimental.list_physical_devices('GPU')
-    if gpus:
-        try:
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        except RuntimeError as e:
-            print(e)
-    import utils_test
-    from utils_test import clustering2, clustering3, ClusteringLayer, clustering2K
-    disabling_blas()
-    save_dir = '../results_ae/'
-    megaAE = tf.keras.models.load_model(save_dir + '/megaAE152_' + identifier + '_' + str(i) + '.h5', 
-             custom_objects={'ClusteringLayer': ClusteringLayer})
-    q, _, _ = megaAE.predict([x_train, x_train])
-    cl_pred = q.argmax(1)
+    from utils_infer import load_inference, predict_chunked
+    disabling_blas(n_threads)
+    model = load_inference(identifier, i, prefix='megaAE152')
+    cl_pred = np.empty(sum([end - start for start, end in rows]), dtype=np.uint8)
+    offset = 0
+    for start, end in rows:
+        # chunked, decoders are not run
+        predict_chunked(model, x[start:end], cluster_out=cl_pred[offset:offset + end - start])
+        offset += end - start
     return cl_pred #, sample
 
 
 
-def fit_predict(x_train, identifier, dims, n_clusters_list, i):
+def fit_predict(x, rows, identifier, dims, n_clusters_list, i, warm_start=None, finetune_steps=140*5*4, n_threads=1):
+    # x: the whole cohort, rows: (start, end) ranges of the training events in it (see utils_fcs.row_ranges)
+    # warm_start: identifier of the full-cohort megaAEs, if given rep i of it is fine-tuned on x_train for at most
+    # finetune_steps steps (its clusters are kept) instead of running DEC from the pretrained weights of identifier,
+    # its number of clusters must be n_clusters_list[i]
     # set reproducibility
+    disabling_blas(n_threads)
     import tensorflow as tf
+    from utils_sched import set_tf_threads
+    set_tf_threads(n_threads)
     import csv
     import numpy as np
     import random
     import pandas as pd
-    import flowkit as fk
     from glob import glob
-    from rpy2 import robjects
-    import rpy2.robjects.packages as rpackages
     from tensorflow.keras.callbacks import EarlyStopping
     from tensorflow.keras.initializers import glorot_normal, glorot_uniform, he_normal, lecun_normal
     from tensorflow.keras.layers import concatenate
@@ -114,40 +115,45 @@ def fit_predict(x_train, identifier, dims, n_clusters_list, i):
             print(e)
     # import other scripts
     from importlib import reload
-    from utils_test import clustering2, ClusteringLayer, get_cluster_num, clustering2K
+    from utils_test import clustering2K_compiled
     import utils_test
-    # for reproducibility
-    disabling_blas()
+    from utils_fcs import take_rows
+    # not a copy: the training batches and the chunks of the full passes are read from the slices of the shared x
+    x_train = take_rows(x, rows)
     # seed_value = 42*i
     # utils_test.reproducibility(seed_value)
     dims_a = [x_train.shape[-1]] + dims[0]
     dims_b = [x_train.shape[-1]] + dims[1]
     save_dir = '../results_ae'
-    ae1_wt = glob(save_dir + '/ae1_' + identifier +'_*')[i]
-    ae3_wt = glob(save_dir + '/ae3_' + identifier +'_*')[i]
     n_clusters = n_clusters_list[i]
-    ae1 = utils_test.autoencoder_(dims_a, uniqueID='0')
-    ae3 = utils_test.autoencoder_(dims_b, uniqueID='2')
-    # opt = tf.keras.optimizers.Nadam(learning_rate=1E-5)
-    # opt = tf.keras.optimizers.SGD(learning_rate=0.1, nesterov=True)
-    opt = tf.keras.optimizers.Adagrad(learning_rate=0.1)
-    ae1.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-    ae3.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-    ae1.load_weights(ae1_wt)
-    ae3.load_weights(ae3_wt)
-    merged_hidden = concatenate([ae1.get_layer(name='encoder_' + '03').output,
-                                 ae3.get_layer(name='encoder_' + '23').output])
-    encoder = Model(inputs=[ae1.input, ae3.input], outputs=merged_hidden)
-    clustering_layer = utils_test.ClusteringLayer(n_clusters, name='clustering')(merged_hidden)
-    megaAE = Model(inputs=[ae1.input, ae3.input],
-                   outputs=[clustering_layer, ae1.output, ae3.output])
+    if warm_start is None:
+        # pretrained weights of rep i (not cached since they are trained further)
+        ae1, ae3 = utils_test.load_pretrained(identifier, dims_a, dims_b, i, save_dir, cache=False)
+        merged_hidden = concatenate([ae1.get_layer(name='encoder_' + '03').output,
+                                     ae3.get_layer(name='encoder_' + '23').output])
+        encoder = Model(inputs=[ae1.input, ae3.input], outputs=merged_hidden)
+        clustering_layer = utils_test.ClusteringLayer(n_clusters, name='clustering')(merged_hidden)
+        megaAE = Model(inputs=[ae1.input, ae3.input],
+                       outputs=[clustering_layer, ae1.output, ae3.output])
+    else:
+        # trained full-cohort megaAE of rep i (a fresh copy, it is trained further)
+        megaAE = utils_test.load_megaAE(warm_start, i, cache=False)
+        if megaAE.get_layer(name='clustering').n_clusters != n_clusters:
+            raise ValueError('rep {} of {} has {} clusters, not the {} of n_clusters_list, it cannot be warm-started'.format(
+                i, warm_start, megaAE.get_layer(name='clustering').n_clusters, n_clusters))
+        encoder = Model(inputs=megaAE.input, outputs=utils_test.inference_model(megaAE).output[1])
     megaAE.compile(loss={'clustering': 'kld', 
                         'decoder_' + '00': 'mse',
                         'decoder_' + '20': 'mse'},
                    loss_weights=[0.5, 1/4, 1/4],
                    optimizer='Adam')#tf.keras.optimizers.Adam(learning_rate=0.0001))
-    cl = clustering2K(model=megaAE, encoder=encoder, x=x_train, n_clusters=n_clusters, tol=0.03, batch_size=2**10, update_interval=140*5)
+    if warm_start is None:
+        cl = clustering2K_compiled(model=megaAE, encoder=encoder, x=x_train, n_clusters=n_clusters, tol=0.03, batch_size=2**10, update_interval=140*5)
+    else:
+        cl = clustering2K_compiled(model=megaAE, encoder=encoder, x=x_train, tol=0.03, batch_size=2**10, update_interval=140*5,
+                                   maxiter=finetune_steps, kmeans_init=False)
     megaAE.save(save_dir + '/megaAE152_' + identifier + '_' + str(i) + '.h5')
+    utils_test.export_npz(megaAE, save_dir + '/megaAE152_' + identifier + '_' + str(i) + '.npz')
     return cl #, sample.to_list()
 #best rn batch^10, intervalx1, tol0.03
 
@@ -158,10 +164,7 @@ def automated_cluster(x_train, identifier, dims):
     import numpy as np
     import random
     import pandas as pd
-    import flowkit as fk
     from glob import glob
-    from rpy2 import robjects
-    import rpy2.robjects.packages as rpackages
     from tensorflow.keras.callbacks import EarlyStopping
     from tensorflow.keras.initializers import glorot_normal, glorot_uniform, he_normal, lecun_normal
     from tensorflow.keras.layers import concatenate
@@ -175,28 +178,18 @@ def automated_cluster(x_train, identifier, dims):
         except RuntimeError as e:
             print(e)
     # import other scripts
-    from importlib import reload
     import utils_test
-    reload(utils_test)
-    from utils_test import clustering2, clustering3, get_cluster_num
+    from utils_test import get_cluster_num
     # for reproducibility
     disabling_blas()
     n_clusters = []
-    x_train = x_train.to_numpy()
+    x_train = np.asarray(x_train)
     dims_a = [x_train.shape[-1]] + dims[0]
     dims_b = [x_train.shape[-1]] + dims[1]
     save_dir = '../results_ae'
-    for i in range(len(glob(save_dir + '/ae1_' + identifier +'_*'))):
+    for i in utils_test.rep_files(identifier, 'ae1', save_dir):
         print('Working on best cluster number for rep {}'.format(i))
-        ae1_wt = glob(save_dir + '/ae1_' + identifier +'_*')[i]
-        ae3_wt = glob(save_dir + '/ae3_' + identifier +'_*')[i]
-        ae1 = utils_test.autoencoder_(dims_a, uniqueID='0')
-        ae3 = utils_test.autoencoder_(dims_b, uniqueID='2')
-        opt = tf.keras.optimizers.Adagrad(learning_rate=0.1)
-        ae1.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-        ae3.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-        ae1.load_weights(ae1_wt)
-        ae3.load_weights(ae3_wt)
+        ae1, ae3 = utils_test.load_pretrained(identifier, dims_a, dims_b, i, save_dir)
         merged_hidden = concatenate([ae1.get_layer(name='encoder_' + '03').output,
                                     ae3.get_layer(name='encoder_' + '23').output])
         encoder = Model(inputs=[ae1.input, ae3.input], outputs=merged_hidden)
@@ -215,96 +208,78 @@ def automated_cluster(x_train, identifier, dims):
 import os
 import numpy as np
 import pandas as pd
-import flowkit as fk
 from glob import glob
-import multiprocessing
+from utils_fcs import ingest_fcs, load_events, share_array, encode_samples, to_exchange, row_ranges
+from utils_sched import run_scheduled, available_cores
 from joblib import Parallel, delayed
 from sklearn.preprocessing import StandardScaler, QuantileTransformer
 from itertools import combinations 
 from sklearn.preprocessing import StandardScaler, MinMaxScaler, normalize, QuantileTransformer
 
 
-num_cores = multiprocessing.cpu_count()
+num_cores = len(available_cores())
 reps = 10
 sess = 1
 fcs_path = '../raw_data/max_events/fcs/'
 files = np.sort(glob(fcs_path + '*_LowNo*.fcs'))
 files = np.array([x for x in files if (('HF14-017' not in x) & ('HF14-083' not in x) & ('HF14-025' not in x))])
+# order the files by sample so that the events of each sample are one block of rows of the cohort
+files = np.array(sorted(files, key=lambda file: (file.split('_')[-1], file)))
 # omit 2 samples for testing
 file_options = ['HF13-117', 'HF14-008', 'HF14-051', 'HF14-053', 'HF14-057', 'HF14-076']
 pairs = list(combinations(file_options, 1))
+# None: every reduced cohort is clustered by a full DEC run from its pretrained weights (the original study).
+# warm start: set to the identifier of the full-cohort megaAEs (from 3_AE_clustering.py) to fine-tune them on each
+# reduced cohort for at most finetune_steps steps instead. this is faster but measures something else: the clusters
+# start from the full-cohort ones (which saw the held-out sample) rather than being found again, so the results are
+# not comparable with the original study. the megaAEs must have the clusters of n_clusters_list (checked per rep)
+warm_start = None # e.g. 'allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd'
+finetune_steps = 140*5*4
+exchange_format = 'parquet' # format of the exports for R: 'parquet', 'feather' or 'csv' (see utils_fcs.to_exchange)
+dims = [[512, 256, 128, 10], [512, 256, 128, 5]]
+excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
+                'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
+            #    'PARKIN', 'TMEM230_C20orf30', 'DJ-1_PARK7', 'GBA1'] #possible
+# decode the cohort once, every held-out iteration (training and both predictions) takes its rows from it
+x, columns, counts = load_events(files, exclude=excludedPro + ['NET'], n_jobs=num_cores)
+x = share_array(x) # the rep workers attach to x read-only instead of each getting a copy
+
+
+# predict and export to R ---------------------------------------------------------------------
+def get_predict(keep, identifier_pred, reps, post=False):
+    # keep: which files (of files) to predict
+    rows = row_ranges(counts, keep)
+    if post:
+        names = ['_'.join(['post', file.split('/')[4].split('_')[0], file.split('_')[5], 
+                           file.split('_')[6], file.split('_')[-1]]) for file in files[keep]]
+    else:
+        names = ['_'.join(['pre', file.split('/')[4].split('_')[0], file.split('_')[3], 
+                           file.split('_')[4], file.split('_')[-1]]) for file in files[keep]]
+    sample_pred, samples = encode_samples(names, counts[keep])
+    res = run_scheduled(predict, [(identifier, x, rows, i) for i in range(reps)])
+    cl_pred = [res[i] for i in range(len(res))]
+    cl_pred = pd.DataFrame(np.column_stack(cl_pred))
+    to_R = pd.concat([cl_pred, pd.DataFrame({'sample': sample_pred})], axis=1)
+    return to_R, samples
 
 
 # for p in pairs:
 for p in pairs:
     pair = p[0]
-    files_train = np.array([x for x in files if (pair not in x)]) # & (pair[1] not in x))])
+    test = np.array([pair in file for file in files])
     identifier = 'allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd_no_' + ','.join(pair)
     # identifier = 'real10' #'allLowNoPresynaptic_105_SGDwithVal_lr_batch210'
-    dims = [[512, 256, 128, 10], [512, 256, 128, 5]]
-    # load files
-    fcs_list = []
-    sample = []
-
-    for file in files_train:
-        ff = fk.Sample(file)
-        events = ff.get_orig_events()
-        sample = sample + ([file.split('_')[-1]] * events.shape[0])
-        fcs_list.append(events)
-
-    df = pd.DataFrame(np.vstack(fcs_list), columns=ff.pnn_labels)
-    sample = pd.Series(sample)
-    excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
-                    'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
-                #    'PARKIN', 'TMEM230_C20orf30', 'DJ-1_PARK7', 'GBA1'] #possible
-    df = df.loc[:, ~df.columns.isin(excludedPro)]
-    df = df.drop(['NET'], axis=1)
-    ## %% --------------------------------------------------------------------------------
-    x_train = np.array(df)#.sample(frac=0.02, random_state=0))
+    # training rows: the cohort without the held-out sample (at most two slices of x)
+    rows_train = row_ranges(counts, ~test)
 
     n_clusters_list = [15]*10
-    res_ = Parallel(n_jobs=reps)(delayed(fit_predict)(pd.DataFrame(x_train), identifier, dims, n_clusters_list, i) for i in range(reps))
-
-    # predict and export to R ---------------------------------------------------------------------
-    def get_predict(files, identifier_pred, reps, post=False):
-        excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
-                    'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
-        # load files
-        fcs_list = []
-        sample_pred = []
-        for file in files:
-            ff = fk.Sample(file)
-            events = ff.get_orig_events()
-            if post:
-                sample_pred = sample_pred + (['_'.join(['post', file.split('/')[4].split('_')[0], file.split('_')[5], 
-                                                        file.split('_')[6], file.split('_')[-1]])] * events.shape[0])
-            else:
-                sample_pred = sample_pred + (['_'.join(['pre', file.split('/')[4].split('_')[0], file.split('_')[3], 
-                                                        file.split('_')[4], file.split('_')[-1]])] * events.shape[0])
-            fcs_list.append(events)
-        df = pd.DataFrame(np.vstack(fcs_list), columns=ff.pnn_labels)
-        sample_pred = pd.Series(sample_pred)#.sample(frac=0.02, random_state=0)
-        excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
-                        'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
-                    #    'PARKIN', 'TMEM230_C20orf30', 'DJ-1_PARK7', 'GBA1'] #possible
-        df = df.loc[:, ~df.columns.isin(excludedPro)]
-        df = df.drop(['NET'], axis=1)
-        ## %% --------------------------------------------------------------------------------
-        x_train = np.array(df)#.sample(frac=0.02, random_state=0).reset_index(drop=True))
-        res = Parallel(n_jobs=reps)(delayed(predict)(identifier, pd.DataFrame(x_train), i) for i in range(reps))
-        cl_pred = [res[i] for i in range(len(res))]
-        cl_pred = pd.DataFrame(np.column_stack(cl_pred))
-        to_R = pd.concat([cl_pred, pd.DataFrame(sample_pred).reset_index(drop=True).rename(columns={0:'sample'})], axis=1)
-        return to_R
+    res_ = run_scheduled(fit_predict, [(x, rows_train, identifier, dims, n_clusters_list, i, warm_start, finetune_steps)
+                                       for i in range(reps)], task_memory=3*int(counts[~test].sum())*x.shape[1]*4)
 
     # get prediction of presynaptic in different groups
-    fcs_path = '../raw_data/max_events/fcs/'
-
     identifier_pred = 'predLowNo' + '_maxK40_' + identifier
-    to_R = get_predict(files_train, identifier_pred, reps)
-    to_R.to_csv('R_py_exchange/presynTOF_AdamMegaAE152' + identifier_pred + '_sess_' + str(sess) + '_no_' + ','.join(pair) + '.csv')
+    to_R, samples = get_predict(~test, identifier_pred, reps)
+    to_exchange(to_R, samples, 'R_py_exchange/presynTOF_AdamMegaAE152' + identifier_pred + '_sess_' + str(sess) + '_no_' + ','.join(pair) + '.' + exchange_format)
 
-    files_test = np.array([x for x in files if ((pair in x))])
-    identifier_pred = 'predLowNo' + '_maxK40_' + identifier
-    to_R = get_predict(files_test, identifier_pred, reps)
-    to_R.to_csv('R_py_exchange/presynTOF_AdamMegaAE152' + identifier_pred.replace(',', '') + '_sess_' + str(sess) + '_for_' + pair + '.csv')
+    to_R, samples = get_predict(test, identifier_pred, reps)
+    to_exchange(to_R, samples, 'R_py_exchange/presynTOF_AdamMegaAE152' + identifier_pred.replace(',', '') + '_sess_' + str(sess) + '_for_' + pair + '.' + exchange_format)
@@ -1,7 +1,6 @@
 ##%% libraries --------------------------------------------------------------------------------
 # to get reproducible results
-def disabling_blas():
-    n_threads = 1
+def disabling_blas(n_threads=1):
     import os
     os.environ['OMP_NUM_THREADS'] = str(n_threads)
     os.environ['OPENBLAS_NUM_THREADS'] = str(n_threads)
@@ -13,11 +12,22 @@ def disabling_blas():
 disabling_blas() # to run purely on cpu
 
 
-def pretrain(x_train, identifier, dims, i):
+def pretrained_files(identifier, i, save_dir='../results_ae'):
+    # the weights pretrain saves for rep i, which the later stages are built from
+    return [save_dir + '/ae1_' + identifier + '_' + str(i) + '.h5', save_dir + '/ae3_' + identifier + '_' + str(i) + '.h5']
+
+
+def pretrain(x_train, identifier, dims, i, key=None, streamed=False, n_threads=1):
     # this function pretrains the AEs before attaching clustering layer to it, identifier and i are used for generating model name tag.
-    # dims are used for node sizes in each layer
+    # dims are used for node sizes in each layer, n_threads is the number of cores this rep can use
+    # (its BLAS and tensorflow intra-op threads), key: if given, the rep is recorded as finished under it (see utils_ckpt)
+    # streamed: if True, the shuffled batches are read from x_train through a prefetching tf.data pipeline (see
+    # utils_test.event_dataset) instead of fitting on the array in memory
     # set reproducibility
+    disabling_blas(n_threads)
     import tensorflow as tf
+    from utils_sched import set_tf_threads
+    set_tf_threads(n_threads)
     from tensorflow.keras.callbacks import EarlyStopping
     from tensorflow.keras.initializers import glorot_normal
     gpus = tf.config.experimental.list_physical_devices('GPU')
@@ -28,8 +38,6 @@ def pretrain(x_train, identifier, dims, i):
         except RuntimeError as e:
             print(e)
     import utils_test
-    # for reproducibility
-    disabling_blas()
     seed_value = 42*i
     cb = EarlyStopping(monitor='r_square', min_delta=0.0025, patience=1, \
         verbose=0, mode='max', baseline=None, restore_best_weights=False)  
@@ -45,18 +53,63 @@ def pretrain(x_train, identifier, dims, i):
     ae1.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
     ae3.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
     # start training
-    ae1.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
-    ae3.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
+    if streamed:
+        ds = utils_test.event_dataset(x_train, batch_size=2**10, seed=seed_value)
+        steps = utils_test.steps_per_epoch(x_train, batch_size=2**10)
+        ae1.fit(ds, epochs=20000, steps_per_epoch=steps, callbacks=[cb, utils_test.EpochThroughput(x_train.shape[0], 'ae1 rep ' + str(i))])
+        ae3.fit(ds, epochs=20000, steps_per_epoch=steps, callbacks=[cb, utils_test.EpochThroughput(x_train.shape[0], 'ae3 rep ' + str(i))])
+    else:
+        ae1.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
+        ae3.fit(x=x_train, y=x_train, batch_size=2**10, epochs=20000, callbacks=[cb], shuffle=True)
     save_dir = '../results_ae'
     # save models
     ae1.save_weights(save_dir + '/ae1_' + identifier + '_' + str(i) + '.h5')
     ae3.save_weights(save_dir + '/ae3_' + identifier + '_' + str(i) + '.h5')
+    if key is not None:
+        from utils_ckpt import record_rep
+        record_rep('pretrain', key, i, outputs=pretrained_files(identifier, i, save_dir))
 
 
-def fit_megaAE(x_train, identifier, dims, n_clusters_list, i):
+def pretrain_ensemble(x_train, identifier, dims, reps, key=None, n_threads=1):
+    # this function pretrains the AEs of all reps together: the weights of the reps are stacked and trained as batched
+    # matmuls in one model (rep i keeps its seed 42*i, for its initial weights and its own batch order, and its own
+    # early stopping), then each rep is saved to the same ae1_/ae3_ files as pretrain. reps: number of reps or the list of reps to train, key: as in pretrain
+    disabling_blas(n_threads)
+    import tensorflow as tf
+    from utils_sched import set_tf_threads
+    set_tf_threads(n_threads)
+    import utils_test
+    reps = list(range(reps)) if isinstance(reps, int) else list(reps)
+    seeds = [42*i for i in reps]
+    utils_test.reproducibility(seeds[0])
+    dims_a = [x_train.shape[-1]] + dims[0]
+    dims_b = [x_train.shape[-1]] + dims[1]
+    save_dir = '../results_ae'
+    for dims_, uniqueID, name in [(dims_a, '0', 'ae1'), (dims_b, '2', 'ae3')]:
+        ensemble = utils_test.ensemble_autoencoder(dims_, seeds, uniqueID=uniqueID)
+        stopped = utils_test.fit_ensemble(ensemble, x_train, epochs=20000, batch_size=2**10, learning_rate=0.1,
+                                          min_delta=0.0025, patience=1, seeds=seeds, name=name)
+        print('{} reps stopped at epochs {}'.format(name, stopped))
+        utils_test.export_ensemble(ensemble, dims_, [save_dir + '/' + name + '_' + identifier + '_' + str(i) + '.h5'
+                                                     for i in reps], uniqueID=uniqueID)
+    if key is not None:
+        from utils_ckpt import record_rep
+        for i in reps:
+            record_rep('pretrain', key, i, outputs=pretrained_files(identifier, i, save_dir))
+
+
+def fit_megaAE(x_train, identifier, dims, n_clusters_list, i, key=None, quantized=False, sampled=False, n_threads=1):
     # This function combine the 2 AEs together, attach the clustering layer, and train the model for clustering
+    # n_threads is the number of cores given to this rep by the scheduler, key: if given, the rep is recorded as
+    # finished under it (see utils_ckpt) and the clustering is snapshotted so that a crashed run continues from there
+    # quantized: if True, the int8 encoders are also exported once the rep is recorded (see utils_infer.quantize)
+    # sampled: if True, convergence is checked on a 131k-event stratified sample with an adaptive interval instead
+    # of a full pass every update_interval steps (see utils_test.clustering2K_compiled)
     # set reproducibility
+    disabling_blas(n_threads)
     import tensorflow as tf
+    from utils_sched import set_tf_threads
+    set_tf_threads(n_threads)
     from glob import glob
     from tensorflow.keras.layers import concatenate
     from tensorflow.keras.models import Model
@@ -69,25 +122,16 @@ def fit_megaAE(x_train, identifier, dims, n_clusters_list, i):
         except RuntimeError as e:
             print(e)
     # import other scripts
-    from utils_test import clustering2K
+    from utils_test import clustering2K_compiled
+    from utils_infer import quantize, quantized_file, npz_file
     import utils_test
-    # for reproducibility
-    disabling_blas()
     # build the exact same AE models
     dims_a = [x_train.shape[-1]] + dims[0]
     dims_b = [x_train.shape[-1]] + dims[1]
     save_dir = '../results_ae'
-    ae1_wt = glob(save_dir + '/ae1_' + identifier +'_*')[i]
-    ae3_wt = glob(save_dir + '/ae3_' + identifier +'_*')[i]
     n_clusters = n_clusters_list[i]
-    ae1 = utils_test.autoencoder_(dims_a, uniqueID='0')
-    ae3 = utils_test.autoencoder_(dims_b, uniqueID='2')
-    opt = tf.keras.optimizers.Adagrad(learning_rate=0.1)
-    ae1.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-    ae3.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-    # initialize weights using the pretrained results
-    ae1.load_weights(ae1_wt)
-    ae3.load_weights(ae3_wt)
+    # initialize weights using the pretrained results of rep i (not cached since they are trained further)
+    ae1, ae3 = utils_test.load_pretrained(identifier, dims_a, dims_b, i, save_dir, cache=False)
     # build mega AE
     merged_hidden = concatenate([ae1.get_layer(name='encoder_' + '03').output,
                                  ae3.get_layer(name='encoder_' + '23').output])
@@ -102,15 +146,53 @@ def fit_megaAE(x_train, identifier, dims, n_clusters_list, i):
                    loss_weights=[0.5, 1/4, 1/4],
                    optimizer='Adam')
     # run clustering
-    cl = clustering2K(model=megaAE, encoder=encoder, x=x_train, n_clusters=n_clusters, tol=0.03, batch_size=2**10, update_interval=140*5)
+    snapshot = None if key is None else save_dir + '/snapshots/' + key[:20] + '/megaAE_' + identifier + '_' + str(i)
+    cl = clustering2K_compiled(model=megaAE, encoder=encoder, x=x_train, n_clusters=n_clusters, tol=0.03, batch_size=2**10, update_interval=140*5,
+                               check_size=2**17 if sampled else None, adaptive=sampled,
+                               snapshot=snapshot, snapshot_every=4)
     megaAE.save(save_dir + '/megaAE_' + identifier + '_' + str(i) + '.h5')
+    # encoders and cluster centers for the tensorflow-free inference (see utils_infer)
+    utils_test.export_npz(megaAE, save_dir + '/megaAE_' + identifier + '_' + str(i) + '.npz')
+    if key is not None:
+        from utils_ckpt import record_rep
+        record_rep('fit_megaAE', key, i, inputs=pretrained_files(identifier, i, save_dir),
+                   outputs=[save_dir + '/megaAE_' + identifier + '_' + str(i) + '.h5',
+                            save_dir + '/megaAE_' + identifier + '_' + str(i) + '.npz'])
+    # int8 encoders for the fast cluster assignment, calibrated on x_train, only after the rep is recorded so that
+    # a failed export does not cost the training (predict_group exports the missing ones too)
+    if quantized:
+        agreement = quantize(identifier, i, x_train, save_dir=save_dir)
+        if key is not None:
+            record_rep('quantize', key, i, inputs=[npz_file(identifier, i, save_dir=save_dir)],
+                       outputs=[quantized_file(identifier, i, save_dir=save_dir)], result=agreement)
     return cl #, sample.to_list()
 
 
-def automated_cluster(x_train, identifier, dims):
-    # This function outputs the optimal number of clusters for x_train. Identifier and i are used for finding the trained model name
+def automated_cluster(x_train, identifier, dims, key=None):
+    # This function outputs the optimal number of clusters of each rep for x_train. Identifier is used for finding the
+    # trained model name, the reps run concurrently with the cores split among them. key: if given, reps recorded
+    # under it (see utils_ckpt) with unchanged pretrained weights are not rerun, their recorded number is returned
+    import utils_test
+    from utils_sched import run_scheduled
+    from utils_ckpt import pending_reps, rep_record
+    reps = list(utils_test.rep_files(identifier, 'ae1', '../results_ae'))
+    todo = reps if key is None else pending_reps('cluster_num', key, reps, lambda i: pretrained_files(identifier, i))
+    n_clusters = dict(zip(todo, run_scheduled(rep_cluster_num, [(x_train, identifier, dims, i, key) for i in todo])))
+    for i in reps:
+        if i not in n_clusters:
+            n_clusters[i] = rep_record('cluster_num', key, i, pretrained_files(identifier, i))['result']
+    return [n_clusters[i] for i in reps]
+
+
+def rep_cluster_num(x_train, identifier, dims, i, key=None, n_threads=1):
+    # This function outputs the optimal number of clusters for x_train of rep i, n_threads is the number of cores
+    # given to this rep by the scheduler (its K sweep, BLAS and tensorflow intra-op threads), key: if given, the
+    # number is recorded under it (see utils_ckpt)
     # set reproducibility
+    disabling_blas(n_threads)
     import tensorflow as tf
+    from utils_sched import set_tf_threads
+    set_tf_threads(n_threads)
     import numpy as np
     from glob import glob
     from tensorflow.keras.layers import concatenate
@@ -124,99 +206,66 @@ def automated_cluster(x_train, identifier, dims):
         except RuntimeError as e:
             print(e)
     # import other scripts
-    from importlib import reload
     import utils_test
-    reload(utils_test)
     from utils_test import get_cluster_num
-    # for reproducibility
-    disabling_blas()
-    n_clusters = []
-    x_train = x_train.to_numpy()
+    from utils_infer import hidden_cache
     dims_a = [x_train.shape[-1]] + dims[0]
     dims_b = [x_train.shape[-1]] + dims[1]
     save_dir = '../results_ae'
-    for i in range(len(glob(save_dir + '/ae1_' + identifier +'_*'))):
-        print('Working on best cluster number for rep {}'.format(i))
-        # load saved model
-        ae1_wt = glob(save_dir + '/ae1_' + identifier +'_*')[i]
-        ae3_wt = glob(save_dir + '/ae3_' + identifier +'_*')[i]
-        ae1 = utils_test.autoencoder_(dims_a, uniqueID='0')
-        ae3 = utils_test.autoencoder_(dims_b, uniqueID='2')
-        opt = tf.keras.optimizers.Adagrad(learning_rate=0.1)
-        ae1.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-        ae3.compile(optimizer=opt, loss='mse', metrics=[utils_test.r_square])
-        ae1.load_weights(ae1_wt)
-        ae3.load_weights(ae3_wt)
-        # define layers
-        merged_hidden = concatenate([ae1.get_layer(name='encoder_' + '03').output,
-                                    ae3.get_layer(name='encoder_' + '23').output])
-        encoder = Model(inputs=[ae1.input, ae3.input], outputs=merged_hidden)
-        # get concat layer name
-        layer_names = [layer.name for layer in encoder.layers]
-        concat_ind = np.max(np.where(['concatenate' in layer for layer in layer_names]))
-        concat_layer = layer_names[concat_ind]
-        get_output = K.function([encoder.input], [encoder.get_layer(concat_layer).output])
-        # get hidden rep. from each AE
-        h = get_output([x_train, x_train, x_train])[0]
-        # get cluster number from the concatenated hidden rep.
-        n_clusters.append(int(get_cluster_num(h, maxK=40, subsampling_n=50000, 
-                           plot_dir='rss_plots/distortions_' + identifier + '_rep' + str(i) + '.png')))
-    return n_clusters
-
-
-def predict(identifier, x_train, i):
-    # This function outputs predicted clusters for x_train. Identifier and i are used for finding the trained model name
-    # set reproducibility
-    import tensorflow as tf
-    gpus = tf.config.experimental.list_physical_devices('GPU')
-    if gpus:
-        try:
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        except RuntimeError as e:
-            print(e)
-    from utils_test import ClusteringLayer
-    disabling_blas()
-    # load saved model
-    save_dir = '../results_ae/'
-    megaAE = tf.keras.models.load_model(save_dir + '/megaAE_' + identifier + '_' + str(i) + '.h5', 
-             custom_objects={'ClusteringLayer': ClusteringLayer})
-    # predict outputs
-    q, _, _ = megaAE.predict([x_train, x_train])
-    cl_pred = q.argmax(1)
-    return cl_pred #, sample
-
-
-
-def get_hidden(x_train, identifier, i):
-    # This function outputs the hidden representation for x_train. Identifier and i are used for finding the trained model name
-    # set reproducibility
-    import tensorflow as tf
-    import numpy as np
-    from tensorflow.keras.models import Model
-    gpus = tf.config.experimental.list_physical_devices('GPU')
-    if gpus:
-        try:
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        except RuntimeError as e:
-            print(e)
-    from utils_test import ClusteringLayer
-    import utils_test
-    disabling_blas()
+    print('Working on best cluster number for rep {}'.format(i))
     # load saved model
-    save_dir = '../results_ae/'
-    megaAE = tf.keras.models.load_model(save_dir + '/megaAE_' + identifier + '_' + str(i) + '.h5', 
-             custom_objects={'ClusteringLayer': ClusteringLayer})
-    # get name of each layer
-    layer_names = [layer.name for layer in megaAE.layers]
+    ae1, ae3 = utils_test.load_pretrained(identifier, dims_a, dims_b, i, save_dir)
+    # define layers
+    merged_hidden = concatenate([ae1.get_layer(name='encoder_' + '03').output,
+                                ae3.get_layer(name='encoder_' + '23').output])
+    encoder = Model(inputs=[ae1.input, ae3.input], outputs=merged_hidden)
+    # get concat layer name
+    layer_names = [layer.name for layer in encoder.layers]
     concat_ind = np.max(np.where(['concatenate' in layer for layer in layer_names]))
     concat_layer = layer_names[concat_ind]
-    # use name to define output section of the model
-    encoder = Model(inputs=megaAE.input, outputs=megaAE.get_layer(name=concat_layer).output)
-    hidden = encoder.predict([x_train, x_train])
-    return hidden #, sample
+    get_output = K.function([encoder.input], [encoder.get_layer(concat_layer).output])
+    # get hidden rep. from each AE, only for the events get_cluster_num samples (cached per model and data)
+    x_sample = x_train[utils_test.cluster_num_sample(x_train.shape[0])]
+    h = hidden_cache([utils_test.rep_files(identifier, 'ae1', save_dir)[i], utils_test.rep_files(identifier, 'ae3', save_dir)[i]],
+                     x_sample, lambda x: get_output([x, x, x])[0], n_hidden=dims[0][-1] + dims[1][-1])
+    # get cluster number from the concatenated hidden rep.
+    n_clusters = int(get_cluster_num(h, maxK=40, subsampling_n=50000, n_jobs=n_threads, sampled=True,
+                                     plot_dir='rss_plots/distortions_' + identifier + '_rep' + str(i) + '.png'))
+    if key is not None:
+        from utils_ckpt import record_rep
+        record_rep('cluster_num', key, i, inputs=pretrained_files(identifier, i, save_dir), result=n_clusters)
+    return n_clusters
+
 
+def predict_group(identifier, x_list, outputs, i, chunk_size=2**17, quantized=False, n_threads=1):
+    # This function loads the model with tag "identifier" of rep i once, and runs the wanted outputs on each
+    # data in x_list: outputs[j] maps 'cluster' (predicted clusters) and/or 'hidden' (hidden representation)
+    # of x_list[j] to shared outputs, whose columns of rep i are filled chunk by chunk.
+    # Both come out of the same encoder-only pass (decoders are not run), which runs in numpy from the exported
+    # weights so the workers do not need tensorflow, and are written straight into the shared outputs.
+    # quantized: if True, the clusters of the data without a hidden output are assigned by the int8 encoders
+    # (see utils_infer.quantize, they are calibrated on the first data if they do not exist yet)
+    import os
+    from utils_infer import load_inference, predict_chunked
+    from utils_infer import load_quantized, quantized_file, quantize
+    disabling_blas(n_threads) # the numpy matmuls use the cores given by the scheduler
+    # load saved model (reused if this worker already loaded it)
+    model = load_inference(identifier, i)
+    model_cluster = model
+    if quantized:
+        if not os.path.exists(quantized_file(identifier, i)):
+            quantize(identifier, i, x_list[0])
+        model_cluster = load_quantized(identifier, i, n_threads=n_threads)
+    for x_train, out in zip(x_list, outputs):
+        cluster_out, hidden_out = out.get('cluster'), out.get('hidden')
+        if cluster_out is not None:
+            cluster_out = cluster_out[:, i]
+        if hidden_out is None:
+            predict_chunked(model_cluster, x_train, cluster_out, chunk_size=chunk_size)
+        else:
+            # the hidden stays float, the clusters that come with it are from the same pass
+            n_hidden = model.n_hidden
+            predict_chunked(model, x_train, cluster_out, hidden_out[:, i*n_hidden:(i+1)*n_hidden], chunk_size=chunk_size)
 
 
 
@@ -235,14 +284,15 @@ def get_hidden(x_train, identifier, i):
 import os
 import numpy as np
 import pandas as pd
-import flowkit as fk
 from glob import glob
-import multiprocessing
 from joblib import Parallel, delayed
+from utils_fcs import ingest_fcs, load_events, share_array, shared_empty, encode_samples, to_exchange
+from utils_sched import run_scheduled, available_cores
+from utils_ckpt import stage_key, pending_reps, rep_record, record_rep
 
 
 # define running parameters
-num_cores = multiprocessing.cpu_count() # use all cores
+num_cores = len(available_cores()) # use all cores (this process may use)
 reps = 10 # run 10 times
 sess = 1 # just a naming of session
 fcs_path = '../raw_data/max_events/fcs/' # path to your syntof fcs files
@@ -250,24 +300,23 @@ files = np.sort(glob(fcs_path + '*_LowNo*.fcs')) # grab desired files
 files = np.array([x for x in files if (('HF14-017' not in x) & ('HF14-083' not in x) & ('HF14-025' not in x))]) # remove non-true LowNo files
 identifier = 'allLowNoPresynaptic_LowNo_08312020Batch210_105_Adagradlr01_noStd' # naming model identifier
 dims = [[512, 256, 128, 10], [512, 256, 128, 5]] # node size in each layer of AE1 and AE3
+ensemble_pretrain = False # pretrain all reps together in one model (pretrain_ensemble) instead of one process per rep
+streamed_pretrain = False # feed the per-rep pretraining through a prefetching tf.data pipeline instead of the in-memory fit
+exchange_format = 'parquet' # format of the exports for R: 'parquet', 'feather' or 'csv' (see utils_fcs.to_exchange)
+quantized_inference = False # assign the exported clusters with the int8 encoders (check their recorded label agreement first)
+sampled_convergence = False # check the clustering convergence on a stratified sample with an adaptive interval instead of full passes
 
+# convert the fcs folders into the memory-mapped columnar cache once (files already in the cache are skipped)
+ingest_fcs(np.sort(glob(fcs_path + '*.fcs')), n_jobs=num_cores)
+ingest_fcs(np.sort(glob('../raw_data/max_events/fcs_post_synap/*.fcs')), n_jobs=num_cores)
 
-# load pre-synaptic fcs files
-fcs_list = []
-sample = []
-for file in files:
-    ff = fk.Sample(file)
-    events = ff.get_orig_events()
-    sample = sample + ([file.split('_')[-1]] * events.shape[0])
-    fcs_list.append(events)
 
-df = pd.DataFrame(np.vstack(fcs_list), columns=ff.pnn_labels)
-sample = pd.Series(sample)
 # excluding non-phenotypic markers
 excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
                 'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
-df = df.loc[:, ~df.columns.isin(excludedPro)]
-df = df.drop(['NET'], axis=1) # drop NET because of low quality
+# load pre-synaptic fcs files into one preallocated float32 matrix (NET dropped because of low quality)
+x_train, columns, counts = load_events(files, exclude=excludedPro + ['NET'], n_jobs=num_cores)
+sample, samples = encode_samples([file.split('_')[-1] for file in files], counts)
 
 
 # # load post-synaptic fcs files
@@ -277,7 +326,7 @@ df = df.drop(['NET'], axis=1) # drop NET because of low quality
 # fcs_list = []
 # sample = []
 # for file in files_post:
-#     ff = fk.Sample(file)
+#     ff = open_fcs(file)
 #     events = ff.get_orig_events()
 #     sample = sample + ([file.split('_')[-1]] * events.shape[0])
 #     fcs_list.append(events)
@@ -292,16 +341,30 @@ df = df.drop(['NET'], axis=1) # drop NET because of low quality
 
 
 ## %% --------------------------------------------------------------------------------
-x_train = np.array(df)#.sample(frac=0.02, random_state=0))
 # x_train_post = np.array(df_post)
 
 
-# run pretrain (10x in parallel)
-Parallel(n_jobs=num_cores)(delayed(pretrain)(pd.DataFrame(x_train), identifier, dims, i) for i in range(reps))
+# publish x_train once, the rep workers attach to it read-only instead of each getting a pickled copy
+x_train = share_array(x_train)
+# every stage records its finished reps in a manifest (see utils_ckpt), a rerun after a crash only runs the reps that
+# are missing. the key of the data is the content hash of the fcs files (from the cache) and the channels used
+data_key = stage_key(ingest_fcs(files), columns, identifier, dims)
+# run pretrain (10x, stacked in one model or in parallel)
+todo = pending_reps('pretrain', data_key, range(reps))
+if ensemble_pretrain and (len(todo) > 0):
+    pretrain_ensemble(x_train, identifier, dims, todo, key=data_key, n_threads=num_cores)
+elif len(todo) > 0:
+    # (the cores are split among the reps, a rep's tensorflow graph and batches hold about 2 copies of x_train)
+    run_scheduled(pretrain, [(x_train, identifier, dims, i, data_key, streamed_pretrain) for i in todo], task_memory=2*x_train.nbytes)
 # run getting optimal cluster numbers
-n_clusters_list = automated_cluster(pd.DataFrame(x_train), identifier, dims)
-# run clustering in parallel
-res_ = Parallel(n_jobs=reps)(delayed(fit_megaAE)(pd.DataFrame(x_train), identifier, dims, n_clusters_list, i) for i in range(reps))
+n_clusters_list = automated_cluster(x_train, identifier, dims, key=data_key)
+# run clustering in parallel (the reps that stopped halfway continue from their last snapshot)
+# (x_train, p and the shuffled batches live in each rep's graph, about 3 copies of x_train)
+fit_key = stage_key(data_key, n_clusters_list, sampled_convergence)
+todo = pending_reps('fit_megaAE', fit_key, range(reps), lambda i: pretrained_files(identifier, i))
+res_ = run_scheduled(fit_megaAE, [(x_train, identifier, dims, n_clusters_list, i, fit_key, quantized_inference, sampled_convergence)
+                                   for i in todo],
+                     task_memory=3*x_train.nbytes)
 
 
 
@@ -310,137 +373,90 @@ res_ = Parallel(n_jobs=reps)(delayed(fit_megaAE)(pd.DataFrame(x_train), identifi
 
 
 
-# predict clusters and export to csv ---------------------------------------------------------------------
-import pandas as pd
-import flowkit as fk
+# predict clusters, get hidden and export to R ---------------------------------------------------------
+def sample_name(file, naming):
+    # This function gives the sample name written to R for a file, naming is 'pre' or 'post' for the cluster
+    # exports of pre-/post-synaptic files and 'hidden' for the hidden representation export
+    if naming == 'post':
+        return '_'.join(['post', file.split('/')[4].split('_')[0], file.split('_')[5], file.split('_')[6], file.split('_')[-1]])
+    elif naming == 'pre':
+        return '_'.join(['pre', file.split('/')[4].split('_')[0], file.split('_')[3], file.split('_')[4], file.split('_')[-1]])
+    return '_'.join([file.split('/')[4].split('_')[0], file.split('_')[3], file.split('_')[-1]])
 
 
-def get_predict(files, identifier, reps, post=False):
-    # This function loads wanted data and call prediction function of the model with tag "identifier". 
-    # It outputs cluster prediction for each event (along with the event itself)
+def run_exports(groups, exports, reps, n_jobs, n_hidden, chunk_size=2**17, quantized=False):
+    # This function runs all the exports with each data group loaded once and each (model, rep) loaded once.
+    # groups: dict of group name -> fcs files
+    # exports: list of (group name, model identifier, output ('cluster' or 'hidden'), sample naming, output file)
+    # n_hidden: size of the concatenated hidden layer, chunk_size: number of events per inference step
+    # quantized: assign the clusters with the int8 encoders (see predict_group), the hidden stays float
+    # exports already written from the same fcs files and models (recorded in their manifest) are skipped
+    from utils_infer import npz_file, quantized_file
     excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
                    'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
-    # load files
-    fcs_list = []
-    sample_pred = []
-    for file in files:
-        ff = fk.Sample(file)
-        events = ff.get_orig_events()
-        if post:
-            sample_pred = sample_pred + (['_'.join(['post', file.split('/')[4].split('_')[0], file.split('_')[5], 
-                                                    file.split('_')[6], file.split('_')[-1]])] * events.shape[0])
+    keys = {e: stage_key(ingest_fcs(groups[e[0]]), excludedPro, e[1:], reps, quantized) for e in exports}
+    inputs = {e: [npz_file(e[1], i) for i in range(reps)] for e in exports}
+    if quantized:
+        inputs = {e: inputs[e] + [quantized_file(e[1], i) for i in range(reps)] if e[2] == 'cluster' else inputs[e]
+                  for e in exports}
+    exports = [e for e in exports if rep_record('export', keys[e], 0, inputs[e]) is None]
+    print('{} exports to write'.format(len(exports)))
+    if len(exports) == 0:
+        return
+    # load each group once
+    data = {}
+    for group in dict.fromkeys([e[0] for e in exports]):
+        x, columns, counts = load_events(groups[group], exclude=excludedPro + ['NET'], n_jobs=n_jobs)
+        data[group] = (share_array(x), counts)
+    # shared outputs with one column (cluster) or n_hidden columns (hidden) per rep, the workers write into them
+    # directly (cluster numbers are at most maxK=40, so they fit in uint8)
+    results = {}
+    for group, m, output, naming, file in exports:
+        if output == 'cluster':
+            results[(group, m, output)] = shared_empty((data[group][0].shape[0], reps), dtype=np.uint8)
         else:
-            sample_pred = sample_pred + (['_'.join(['pre', file.split('/')[4].split('_')[0], file.split('_')[3], 
-                                                    file.split('_')[4], file.split('_')[-1]])] * events.shape[0])
-        fcs_list.append(events)
-    df = pd.DataFrame(np.vstack(fcs_list), columns=ff.pnn_labels)
-    sample_pred = pd.Series(sample_pred)#.sample(frac=0.02, random_state=0)
-    df = df.loc[:, ~df.columns.isin(excludedPro)]
-    df = df.drop(['NET'], axis=1)
-    # get predictions
-    x_train = np.array(df)#.sample(frac=0.02, random_state=0).reset_index(drop=True))
-    res = Parallel(n_jobs=reps)(delayed(predict)(identifier, pd.DataFrame(x_train), i) for i in range(reps))
-    cl_pred = [res[i] for i in range(len(res))]
-    cl_pred = pd.DataFrame(np.column_stack(cl_pred))
-    to_R = pd.concat([cl_pred, pd.DataFrame(sample_pred).reset_index(drop=True).rename(columns={0:'sample'})], axis=1)
-    return to_R
-
-
-# get prediction of presynaptic in different groups
-fcs_path = '../raw_data/max_events/fcs/'
-
-files = np.sort(glob(fcs_path + '*_LowNo*.fcs'))
-identifier_pred = 'predLowNo' + '_maxK40_' + identifier
-to_R = get_predict(files, identifier_pred, reps)
-to_R.to_csv('R_py_exchange/presynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-files = np.sort(glob(fcs_path + '*_LBD*.fcs'))
-identifier_pred = 'predLBD' + '_maxK40_' + identifier
-to_R = get_predict(files, identifier_pred, reps)
-to_R.to_csv('R_py_exchange/presynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-files = np.sort(glob(fcs_path + '*_PHAD*.fcs'))
-identifier_pred = 'predPHAD' + '_maxK40_' + identifier
-to_R = get_predict(files, identifier_pred, reps)
-to_R.to_csv('R_py_exchange/presynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-# get prediction of postsynaptic in different groups
-fcs_path = '../raw_data/max_events/fcs_post_synap/'
-
-files = np.sort(glob(fcs_path + '*_LowNo*.fcs'))
-identifier_pred = 'predLowNo' + '_maxK40_' + identifier
-to_R = get_predict(files, identifier_pred, reps, post=True)
-to_R.to_csv('R_py_exchange/postsynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-files = np.sort(glob(fcs_path + '*_LBD*.fcs'))
-identifier_pred = 'predLBD' + '_maxK40_' + identifier
-to_R = get_predict(files, identifier_pred, reps, post=True)
-to_R.to_csv('R_py_exchange/postsynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-files = np.sort(glob(fcs_path + '*_PHAD*.fcs'))
-identifier_pred = 'predPHAD' + '_maxK40_' + identifier
-to_R = get_predict(files, identifier_pred, reps, post=True)
-to_R.to_csv('R_py_exchange/postsynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
+            results[(group, m, output)] = shared_empty((data[group][0].shape[0], reps*n_hidden), dtype=np.float32)
+    # one task per (model, rep), it runs every export that uses this model with one pass per group
+    models = list(dict.fromkeys([e[1] for e in exports]))
+    model_groups = {m: list(dict.fromkeys([e[0] for e in exports if e[1] == m])) for m in models}
+    model_outputs = {m: [{e[2]: results[(g, m, e[2])] for e in exports if (e[1] == m) & (e[0] == g)}
+                         for g in model_groups[m]] for m in models}
+    # the scheduler balances the tasks by their number of events over at most n_jobs cores
+    size = {m: sum([data[g][0].shape[0] for g in model_groups[m]]) for m in models}
+    tasks = [(m, i) for m in models for i in range(reps)]
+    run_scheduled(predict_group, [(m, [data[g][0] for g in model_groups[m]], model_outputs[m], i, chunk_size, quantized)
+                                  for m, i in tasks],
+                  sizes=[size[m] for m, i in tasks], cores=available_cores()[:n_jobs])
+    # write each export with its reps as columns
+    for group, m, output, naming, file in exports:
+        out = pd.DataFrame(results[(group, m, output)])
+        sample_pred, samples = encode_samples([sample_name(f, naming) for f in groups[group]], data[group][1])
+        to_R = pd.concat([out, pd.DataFrame({'sample': sample_pred})], axis=1)
+        written = to_exchange(to_R, samples, file)
+        record_rep('export', keys[(group, m, output, naming, file)], 0, inputs[(group, m, output, naming, file)],
+                   outputs=written)
 
-# # get prediction of GFAP- EAAT1- presynaptic
-# fcs_path = '../raw_data/max_events/fcs_GFAPnegEAAT1neg/'
 
-# files = np.sort(glob(fcs_path + '*_LowNo*.fcs'))
-# identifier_pred = 'predLowNo' + '_maxK40_' + identifier
-# to_R = get_predict(files, identifier_pred, reps)
-# to_R.to_csv('R_py_exchange/presynTOFGFAPnegEAAT1neg_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-# files = np.sort(glob(fcs_path + '*_LBD*.fcs'))
-# identifier_pred = 'predLBD' + '_maxK40_' + identifier
-# to_R = get_predict(files, identifier_pred, reps)
-# to_R.to_csv('R_py_exchange/presynTOFGFAPnegEAAT1neg_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-# files = np.sort(glob(fcs_path + '*_PHAD*.fcs'))
-# identifier_pred = 'predPHAD' + '_maxK40_' + identifier
-# to_R = get_predict(files, identifier_pred, reps)
-# to_R.to_csv('R_py_exchange/presynTOFGFAPnegEAAT1neg_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.csv')
-
-
-
-# get hidden and export to R -----------------------------------------------------------------
 fcs_path = '../raw_data/max_events/fcs/'
-excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
-                'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
-
-files = np.sort(glob(fcs_path + '*_LowNo*.fcs'))
-
-# load files
-fcs_list = []
-sample_pred = []
-for file in files:
-    ff = fk.Sample(file)
-    events = ff.get_orig_events()
-    sample_pred = sample_pred + (['_'.join([file.split('/')[4].split('_')[0], file.split('_')[3], file.split('_')[-1]])] * events.shape[0])
-    fcs_list.append(events)
-
-df = pd.DataFrame(np.vstack(fcs_list), columns=ff.pnn_labels)
-sample_pred = pd.Series(sample_pred)#.sample(frac=0.02, random_state=0).reset_index(drop=True)
-excludedPro = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
-                'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
-            #    'PARKIN', 'TMEM230_C20orf30', 'DJ-1_PARK7', 'GBA1'] #possible
-df = df.loc[:, ~df.columns.isin(excludedPro)]
-df = df.drop(['NET'], axis=1)
-
-## %% --------------------------------------------------------------------------------
-x_train = np.array(df)#.sample(frac=0.02, random_state=0))
-
-
-res = Parallel(n_jobs=reps)(delayed(get_hidden)(pd.DataFrame(x_train), identifier, i) for i in range(reps))
-hidden = [res[i] for i in range(len(res))]
-hidden_ = pd.DataFrame(np.column_stack(hidden))
-
-to_R = pd.concat([hidden_, pd.DataFrame(sample_pred).rename(columns={0:'sample'})], axis=1)
-to_R.to_csv('R_py_exchange/hidden_' + identifier + '_sess_' + str(sess) + '.csv')
\ No newline at end of file
+fcs_path_post = '../raw_data/max_events/fcs_post_synap/'
+fcs_path_neg = '../raw_data/max_events/fcs_GFAPnegEAAT1neg/'
+groups = {'pre' + g: np.sort(glob(fcs_path + '*_' + g + '*.fcs')) for g in ['LowNo', 'LBD', 'PHAD']}
+groups.update({'post' + g: np.sort(glob(fcs_path_post + '*_' + g + '*.fcs')) for g in ['LowNo', 'LBD', 'PHAD']})
+# groups.update({'neg' + g: np.sort(glob(fcs_path_neg + '*_' + g + '*.fcs')) for g in ['LowNo', 'LBD', 'PHAD']})
+
+exports = []
+for g in ['LowNo', 'LBD', 'PHAD']:
+    identifier_pred = 'pred' + g + '_maxK40_' + identifier
+    # get prediction of presynaptic in different groups
+    exports.append(('pre' + g, identifier_pred, 'cluster', 'pre',
+                    'R_py_exchange/presynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.' + exchange_format))
+    # get prediction of postsynaptic in different groups
+    exports.append(('post' + g, identifier_pred, 'cluster', 'post',
+                    'R_py_exchange/postsynTOF_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.' + exchange_format))
+    # get prediction of GFAP- EAAT1- presynaptic
+    # exports.append(('neg' + g, identifier_pred, 'cluster', 'pre',
+    #                 'R_py_exchange/presynTOFGFAPnegEAAT1neg_AdamMegaAE' + identifier_pred + '_sess_' + str(sess) + '.' + exchange_format))
+# get hidden of presynaptic LowNo
+exports.append(('preLowNo', identifier, 'hidden', 'hidden', 'R_py_exchange/hidden_' + identifier + '_sess_' + str(sess) + '.' + exchange_format))
+
+run_exports(groups, exports, reps, num_cores, n_hidden=dims[0][-1] + dims[1][-1], quantized=quantized_inference)
@@ -0,0 +1,5 @@
+# the scripts import their utils_* modules by name, so the tests run with scripts_synTOF on the path
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
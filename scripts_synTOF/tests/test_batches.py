@@ -0,0 +1,17 @@
+"""
+Checks of the batching of the training pipelines (utils_test.index_batches, used by event_dataset,
+clustering2K_compiled and fit_ensemble).
+"""
+
+import numpy as np
+
+
+def test_index_batches_are_epochs():
+    import utils_test
+    n, batch_size = 1000, 128
+    steps = utils_test.steps_per_epoch(np.empty((n, 1)), batch_size)
+    batches = iter(utils_test.index_batches(n, batch_size, seed=4))
+    for epoch in range(3):
+        index = np.concatenate([next(batches).numpy() for _ in range(steps)])
+        # every event exactly once per epoch, no batch crosses into the next epoch
+        np.testing.assert_array_equal(np.sort(index), np.arange(n))
@@ -0,0 +1,29 @@
+"""
+Checks of the K sweep of get_cluster_num (utils_test.kmeans_sweep) against independent k-means fits.
+"""
+
+import numpy as np
+
+
+def elbow(Ks, distortions):
+    # the K get_cluster_num picks from a distortion curve
+    from utils_test import get_segment_num
+    from utils_elbow import fit_pwl
+    segment_num = get_segment_num(np.array(Ks), np.array(distortions))
+    _, res, _ = fit_pwl(np.array(Ks), np.array(distortions), int(segment_num[0]))
+    return int(np.ceil(res[int(segment_num[0] - 1)]))
+
+
+def test_sweep_elbow_matches_restarted_fits():
+    from sklearn.cluster import KMeans
+    from sklearn.datasets import make_blobs
+    from utils_test import kmeans_sweep, min_distance
+    # overlapping blobs, where a single warm-started continuation per K picks 13
+    h, _ = make_blobs(5000, 15, centers=12, cluster_std=2.0, random_state=12)
+    h = h.astype(np.float32)
+    Ks = list(range(5, 41))
+    reference = [np.mean(np.sqrt(min_distance(h, KMeans(n_clusters=k, n_init=20, random_state=1).fit(h).cluster_centers_)))
+                 for k in Ks]
+    distortions = kmeans_sweep(h, Ks, seed=1)
+    assert elbow(Ks, distortions) == elbow(Ks, reference)
+    assert np.max(distortions / np.array(reference) - 1) < 0.02
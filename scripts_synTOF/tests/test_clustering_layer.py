@@ -0,0 +1,21 @@
+"""
+Checks of the one-matmul ClusteringLayer against the difference form it replaced.
+"""
+
+import numpy as np
+
+
+def test_clustering_layer_matches_difference_form():
+    import tensorflow as tf
+    from utils_test import ClusteringLayer
+    rng = np.random.RandomState(2)
+    inputs = rng.randn(2000, 15).astype(np.float32) * 3
+    clusters = rng.randn(20, 15).astype(np.float32) * 3
+    layer = ClusteringLayer(20, weights=[clusters])
+    q = layer(tf.constant(inputs)).numpy()
+    # q as computed before, from the (n_samples, n_clusters, n_features) differences
+    q_ref = 1.0 / (1.0 + np.sum(np.square(inputs[:, None, :].astype(np.float64) - clusters), axis=2) / layer.alpha)
+    q_ref **= (layer.alpha + 1.0) / 2.0
+    q_ref = q_ref / q_ref.sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(q, q_ref, rtol=1e-3, atol=1e-6)
+    assert np.array_equal(q.argmax(1), q_ref.argmax(1))
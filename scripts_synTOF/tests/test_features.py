@@ -0,0 +1,46 @@
+"""
+Checks of the feature engine (utils_features) against the grouped per-event table it replaced.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def test_cluster_sums_match_groupby():
+    from utils_features import cluster_sums, cluster_means
+    rng = np.random.RandomState(3)
+    n_samples, n_clusters = 7, 15
+    x = rng.lognormal(size=(30000, 5)).astype(np.float32)
+    codes = np.sort(rng.randint(0, n_samples, x.shape[0]))
+    labels = rng.randint(0, n_clusters - 1, x.shape[0]) # the last cluster has no events
+    labels[codes == 0] = 0 # nor the first sample except in cluster 0
+    counts, sums = cluster_sums(x, labels, codes, n_samples, n_clusters, chunk_size=4096)
+    means = cluster_means(counts, sums)
+    df = pd.DataFrame(x.astype(np.float64)).assign(sample=codes, mc=labels)
+    ref_means = df.groupby(['sample', 'mc']).mean()
+    ref_counts = df.groupby(['sample', 'mc']).size()
+    full = pd.MultiIndex.from_product([range(n_samples), range(n_clusters)], names=['sample', 'mc'])
+    ref_means = ref_means.reindex(full).to_numpy().reshape(n_samples, n_clusters, x.shape[1])
+    ref_counts = ref_counts.reindex(full, fill_value=0).to_numpy().reshape(n_samples, n_clusters)
+    np.testing.assert_array_equal(counts, ref_counts)
+    np.testing.assert_allclose(means, ref_means, rtol=1e-10)
+    assert np.array_equal(np.isnan(means), np.isnan(ref_means))
+
+
+def test_freq_table_shares():
+    from utils_features import freq_table, cluster_order, CLUSTER_NAMES
+    rng = np.random.RandomState(4)
+    counts = rng.randint(1, 100, size=(4, len(CLUSTER_NAMES)))
+    counts[2, CLUSTER_NAMES.index('A2')] = 0 # one sample without events in A2
+    samples = ['s3', 's1', 's4', 's2']
+    table = freq_table(counts, 'LBD', samples)
+    assert list(table['sample']) == sorted(samples)
+    assert list(table.columns[2:]) == cluster_order()
+    # A2 keeps the counts (NaN where there are none), the other columns are shares out of them
+    rows = np.argsort(samples)
+    a2 = counts[rows, CLUSTER_NAMES.index('A2')].astype(float)
+    np.testing.assert_array_equal(table['A2'].to_numpy(), np.where(a2 > 0, a2, np.nan))
+    others = [cluster for cluster in cluster_order() if cluster != 'A2']
+    np.testing.assert_allclose(table[others].sum(axis=1), 1.0)
+    c1 = counts[rows, CLUSTER_NAMES.index('C1')] / counts[rows][:, [CLUSTER_NAMES.index(c) for c in others]].sum(1)
+    np.testing.assert_allclose(table['C1'], c1)
@@ -0,0 +1,37 @@
+"""
+Checks of the numpy inference engine (utils_infer) against the keras inference model.
+"""
+
+import numpy as np
+
+
+def small_megaAE(n_markers=12, n_clusters=6, seed=0):
+    # an untrained megaAE with the architecture of fit_megaAE (smaller layers), cluster centers drawn at random
+    from tensorflow.keras.layers import concatenate
+    from tensorflow.keras.models import Model
+    import utils_test
+    utils_test.reproducibility(seed)
+    ae1 = utils_test.autoencoder_([n_markers, 32, 16, 4], uniqueID='0')
+    ae3 = utils_test.autoencoder_([n_markers, 32, 16, 3], uniqueID='2')
+    merged_hidden = concatenate([ae1.get_layer(name='encoder_02').output, ae3.get_layer(name='encoder_22').output])
+    clustering_layer = utils_test.ClusteringLayer(n_clusters, name='clustering')(merged_hidden)
+    megaAE = Model(inputs=[ae1.input, ae3.input], outputs=[clustering_layer, ae1.output, ae3.output])
+    megaAE.get_layer(name='clustering').set_weights([np.random.RandomState(seed).randn(n_clusters, 7).astype(np.float32)])
+    return megaAE
+
+
+def test_numpy_inference_matches_keras(tmp_path):
+    import utils_test
+    from utils_infer import load_npz, predict_chunked
+    megaAE = small_megaAE()
+    utils_test.export_npz(megaAE, str(tmp_path / 'megaAE.npz'))
+    x = np.random.RandomState(1).randn(5000, 12).astype(np.float32)
+    q_keras, hidden_keras = utils_test.inference_model(megaAE).predict([x, x], batch_size=2**10, verbose=0)
+    q_numpy, hidden_numpy = load_npz(str(tmp_path / 'megaAE.npz')).predict([x, x])
+    np.testing.assert_allclose(hidden_numpy, hidden_keras, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(q_numpy, q_keras, rtol=1e-4, atol=1e-5)
+    # the chunked path writes the same labels and hidden
+    labels, hidden = np.empty(x.shape[0], dtype=np.uint8), np.empty_like(hidden_numpy)
+    predict_chunked(load_npz(str(tmp_path / 'megaAE.npz')), x, labels, hidden, chunk_size=1000)
+    np.testing.assert_array_equal(hidden, hidden_numpy)
+    assert np.mean(labels == q_keras.argmax(1)) > 0.999
@@ -0,0 +1,23 @@
+"""
+Checks of the rep scheduler (utils_sched).
+"""
+
+
+def tf_threads(n_threads=1):
+    import tensorflow as tf
+    from utils_sched import set_tf_threads
+    set_tf_threads(n_threads)
+    tf.constant(1.0) + 1 # initializes tensorflow
+    return tf.config.threading.get_intra_op_parallelism_threads()
+
+
+def test_plans_get_fresh_workers():
+    import pytest
+    from utils_sched import run_scheduled
+    # (the slots repeat core 0 so that the test runs on any machine, only their sizes matter here)
+    # a second plan with other slots must not run in the workers whose tensorflow threads the first plan fixed
+    assert run_scheduled(tf_threads, [()] * 2, cores=[0, 0, 0, 0]) == [2, 2]
+    assert run_scheduled(tf_threads, [()], cores=[0, 0, 0]) == [3]
+    # and a worker that cannot get its threads fails instead of running with the wrong ones
+    with pytest.raises(RuntimeError):
+        run_scheduled(lambda n_threads: (tf_threads(n_threads), tf_threads(n_threads + 1)), [()], cores=[0])
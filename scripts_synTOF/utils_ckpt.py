@@ -0,0 +1,80 @@
+"""
+This script contains the completion manifests that let 3_AE_clustering.py resume after a crash. When a rep of a stage
+finishes, it records the key of the stage (hash of its data and parameters) and the content hashes of the files it
+was built from and of the files it wrote. A rerun skips every rep whose record still matches and only runs the rest.
+"""
+
+import os
+import json
+import time
+import hashlib
+
+
+MANIFEST_DIR = '../results_ae/manifests/' # default location of the manifests
+_file_hashes = {} # (path, size, mtime) -> content hash
+
+
+def stage_key(*inputs):
+    """
+    this function returns the key of a stage, the sha1 of the repr of its inputs (e.g. the cache keys of the fcs
+    files, the channels and the model parameters)
+    """
+    return hashlib.sha1(repr(inputs).encode()).hexdigest()
+
+
+def _hash(file):
+    # content hash of a file, rehashed only when its size or mtime changed
+    from utils_fcs import file_hash
+    stat = os.stat(file)
+    key = (os.path.abspath(file), stat.st_size, stat.st_mtime)
+    if key not in _file_hashes:
+        _file_hashes[key] = file_hash(file)
+    return _file_hashes[key]
+
+
+def _record_file(stage, key, i, manifest_dir):
+    return os.path.join(manifest_dir, stage, key[:20], 'rep_' + str(i) + '.json')
+
+
+def record_rep(stage, key, i, inputs=(), outputs=(), result=None, manifest_dir=MANIFEST_DIR):
+    """
+    This function marks rep i of stage as finished.
+    inputs: files the rep was built from, outputs: files it wrote, result: json-serializable result of the rep
+    (e.g. its number of clusters) that a rerun gets back instead of recomputing it
+    """
+    record = {'stage': stage, 'key': key, 'rep': i, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'inputs': {file: _hash(file) for file in inputs},
+              'outputs': {file: _hash(file) for file in outputs}, 'result': result}
+    path = _record_file(stage, key, i, manifest_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written next to its final name and renamed, so a crash never leaves a partial record
+    with open(path + '.tmp' + str(os.getpid()), 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(path + '.tmp' + str(os.getpid()), path)
+
+
+def rep_record(stage, key, i, inputs=(), manifest_dir=MANIFEST_DIR):
+    """
+    returns the record of rep i of stage if it finished with the same key and the same input files, and the files
+    it wrote are still unchanged, None otherwise (the rep has to run)
+    """
+    path = _record_file(stage, key, i, manifest_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        record = json.load(f)
+    if sorted(record['inputs']) != sorted(inputs):
+        return None
+    for file, h in list(record['inputs'].items()) + list(record['outputs'].items()):
+        if (not os.path.exists(file)) or (_hash(file) != h):
+            return None
+    return record
+
+
+def pending_reps(stage, key, reps, inputs=None, manifest_dir=MANIFEST_DIR):
+    """
+    returns the reps of stage that have no valid record, inputs(i) gives the input files of rep i
+    """
+    pending = [i for i in reps if rep_record(stage, key, i, [] if inputs is None else inputs(i), manifest_dir) is None]
+    print('{}: {} of {} reps to run'.format(stage, len(pending), len(list(reps))))
+    return pending
@@ -0,0 +1,75 @@
+"""
+This script contains the continuous piecewise linear fit used to find the elbow of the RSS curve (see
+utils_test.get_cluster_num). It is the same model as pwlf (y = b0 + b1*(x - x0) + sum_j b_j+1*(x - break_j)+),
+but the breakpoints are searched exhaustively over a fine grid (then polished locally) instead of by stochastic
+optimization, so the fit is deterministic and needs no optimizer to start up.
+"""
+
+import numpy as np
+from itertools import combinations
+
+
+def hinge_basis(x, breaks):
+    """
+    design matrices of the continuous piecewise linear model, x: (n,), breaks: (m, n_inner) inner breakpoints
+    returns (m, n, n_inner + 2)
+    """
+    m = breaks.shape[0]
+    hinges = np.maximum(x[None, :, None] - breaks[:, None, :], 0)
+    return np.concatenate([np.ones((m, len(x), 1)), np.broadcast_to((x - x[0])[None, :, None], (m, len(x), 1)),
+                           hinges], axis=2)
+
+
+def fit_pwl(x, y, n_segments, step=0.1, chunk_size=2**12):
+    """
+    This function fits a continuous piecewise linear function with n_segments segments to (x, y) by least squares,
+    trying every combination of inner breakpoints on a grid of spacing step between min(x) and max(x), the best
+    one is then refined continuously.
+    Return:
+        ssr: sum of squared residuals of the best fit
+        breaks: breakpoints including both ends (same as pwlf.PiecewiseLinFit.fit)
+        beta: coefficients of the fit (see predict_pwl)
+    """
+    order = np.argsort(x)
+    x = np.asarray(x, dtype=np.float64)[order]
+    y = np.asarray(y, dtype=np.float64)[order]
+    if n_segments == 1:
+        candidates = np.empty((1, 0))
+    else:
+        grid = np.arange(x[0] + step, x[-1] - step / 2, step)
+        candidates = grid[np.array(list(combinations(range(len(grid)), n_segments - 1)))]
+    best = (np.inf, None, None)
+    for start in range(0, candidates.shape[0], chunk_size):
+        breaks = candidates[start:start + chunk_size]
+        A = hinge_basis(x, breaks)
+        # least squares of every candidate at once (pinv handles breakpoints without data in between)
+        beta = np.einsum('mpn,n->mp', np.linalg.pinv(A), y)
+        ssr = np.sum(np.square(y[None, :] - np.einsum('mnp,mp->mn', A, beta)), axis=1)
+        k = int(np.argmin(ssr))
+        if ssr[k] < best[0]:
+            best = (ssr[k], breaks[k], beta[k])
+    ssr, breaks, beta = best
+    if n_segments > 1:
+        # polish the best grid point continuously, the ssr is smooth around it
+        from scipy.optimize import minimize
+        def objective(b):
+            if np.any(b <= x[0]) or np.any(b >= x[-1]) or np.any(np.diff(b) <= 0):
+                return np.inf
+            A = hinge_basis(x, b[None])[0]
+            return np.sum(np.square(y - A @ np.linalg.lstsq(A, y, rcond=None)[0]))
+        res = minimize(objective, breaks, method='Nelder-Mead', options={'xatol': 1e-6, 'fatol': 1e-12})
+        if res.fun < ssr:
+            breaks = res.x
+            A = hinge_basis(x, breaks[None])[0]
+            beta = np.linalg.lstsq(A, y, rcond=None)[0]
+            ssr = res.fun
+    return ssr, np.concatenate([[x[0]], breaks, [x[-1]]]), beta
+
+
+def predict_pwl(x, breaks, beta):
+    """
+    evaluates a fit of fit_pwl at x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    A = np.column_stack([np.ones(len(x)), x - breaks[0]] + [np.maximum(x - b, 0) for b in breaks[1:-1]])
+    return A @ beta
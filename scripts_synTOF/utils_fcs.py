@@ -0,0 +1,394 @@
+"""
+This script contains helpers for loading the single synapse fcs files. Each fcs file is ingested once into a
+memory-mapped columnar cache (one .npy array per channel plus the pnn_labels schema) keyed by the content
+hash of the file, so that the clustering scripts can open the events without re-parsing the fcs files.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import weakref
+import numpy as np
+import pandas as pd
+
+
+CACHE_DIR = '../raw_data/max_events/fcs_cache/' # default location of the columnar cache
+
+
+def file_hash(file, block_size=2**20):
+    """
+    this function returns the sha1 hash of the content of a file
+    """
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_index(cache_dir):
+    # the index maps each fcs path to its size, mtime and content hash so unchanged files are not rehashed
+    index_file = os.path.join(cache_dir, 'index.json')
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            return json.load(f)
+    return {}
+
+
+def _write_index(index, cache_dir):
+    index_file = os.path.join(cache_dir, 'index.json')
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_file + '.tmp', index_file)
+
+
+def _write_entry(file, entry_dir):
+    # parse the fcs file once and write one array per channel, the schema is written last as a completion mark
+    import flowkit as fk
+    ff = fk.Sample(file)
+    events = ff.get_orig_events()
+    tmp_dir = entry_dir + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for j in range(events.shape[1]):
+        np.save(os.path.join(tmp_dir, 'ch%03d.npy' % j), np.ascontiguousarray(events[:, j], dtype=np.float32))
+    with open(os.path.join(tmp_dir, 'schema.json'), 'w') as f:
+        json.dump({'file': os.path.basename(file), 'pnn_labels': list(ff.pnn_labels),
+                   'event_count': int(events.shape[0])}, f)
+    os.replace(tmp_dir, entry_dir)
+
+
+def ingest_fcs(files, cache_dir=CACHE_DIR, n_jobs=1):
+    """
+    This function converts fcs files into the columnar cache (if they are not there yet) and returns
+    the content hash of each file, which is the key of that file in the cache.
+    files whose hash is already in the cache are not parsed again.
+    n_jobs: number of processes used to hash and parse the files (files are independent of each other)
+    """
+    from joblib import Parallel, delayed
+    os.makedirs(cache_dir, exist_ok=True)
+    index = _read_index(cache_dir)
+    paths = [os.path.abspath(file) for file in files]
+    # (re)hash only the files that are new or whose size/mtime changed
+    stats = [os.stat(path) for path in paths]
+    stale = [k for k, path in enumerate(paths) if (path not in index) or
+             (index[path]['size'] != stats[k].st_size) or (index[path]['mtime'] != stats[k].st_mtime)]
+    hashes = Parallel(n_jobs=n_jobs)(delayed(file_hash)(paths[k]) for k in stale)
+    for k, h in zip(stale, hashes):
+        index[paths[k]] = {'size': stats[k].st_size, 'mtime': stats[k].st_mtime, 'hash': h}
+    if len(stale) > 0:
+        _write_index(index, cache_dir)
+    keys = [index[path]['hash'] for path in paths]
+    # parse the files that are not in the cache yet, each worker writes its own entry
+    missing = {key: path for key, path in zip(keys, paths)
+               if not os.path.exists(os.path.join(cache_dir, key, 'schema.json'))}
+    for path in missing.values():
+        print('Ingesting {}'.format(path))
+    Parallel(n_jobs=n_jobs)(delayed(_write_entry)(path, os.path.join(cache_dir, key)) for key, path in missing.items())
+    return keys
+
+
+class CachedSample:
+    """
+    read-only view of one ingested fcs file, every channel is opened as a memory-mapped array (no copy).
+    get_orig_events and pnn_labels mirror flowkit.Sample so it can be used in place of fk.Sample(file).
+    """
+    def __init__(self, key, cache_dir=CACHE_DIR):
+        self.entry_dir = os.path.join(cache_dir, key)
+        with open(os.path.join(self.entry_dir, 'schema.json')) as f:
+            schema = json.load(f)
+        self.original_filename = schema['file']
+        self.pnn_labels = schema['pnn_labels']
+        self.event_count = schema['event_count']
+        self.channels = {label: np.load(os.path.join(self.entry_dir, 'ch%03d.npy' % j), mmap_mode='r')
+                         for j, label in enumerate(self.pnn_labels)}
+
+    def get_channel(self, label):
+        return self.channels[label]
+
+    def get_orig_events(self, labels=None):
+        """
+        returns the events (n_events x n_channels) of the wanted channels (all channels if labels is None)
+        """
+        if labels is None:
+            labels = self.pnn_labels
+        return np.column_stack([self.channels[label] for label in labels])
+
+
+def open_fcs(file, cache_dir=CACHE_DIR):
+    """
+    This function opens an fcs file through the cache (ingesting it first if needed)
+    """
+    return CachedSample(ingest_fcs([file], cache_dir)[0], cache_dir)
+
+
+def read_fcs_header(file):
+    """
+    This function reads only the TEXT segment of an fcs file and returns its keywords as a dict
+    (e.g. $TOT for the number of events and $PnN for the channel names), no event is parsed
+    """
+    with open(file, 'rb') as f:
+        header = f.read(58)
+        text_start, text_end = int(header[10:18]), int(header[18:26])
+        f.seek(text_start)
+        text = f.read(text_end - text_start + 1).decode('utf-8', errors='replace')
+    delim = text[0]
+    # a doubled delimiter is an escaped delimiter inside a keyword value
+    fields = text[1:].replace(delim * 2, '\0').split(delim)
+    fields = [field.replace('\0', delim) for field in fields]
+    return {fields[i].upper(): fields[i + 1] for i in range(0, len(fields) - 1, 2)}
+
+
+def read_fcs_event_count(file):
+    return int(read_fcs_header(file)['$TOT'])
+
+
+def read_fcs_pnn_labels(file):
+    keywords = read_fcs_header(file)
+    return [keywords['$P%dN' % (j + 1)] for j in range(int(keywords['$PAR']))]
+
+
+def _read_into(out, file, key, cache_dir, columns):
+    # decode one file into out (its rows of the output matrix)
+    if key is not None:
+        # copy channel by channel straight from the memory-mapped arrays
+        ff = CachedSample(key, cache_dir)
+        for j, label in enumerate(columns):
+            out[:, j] = ff.get_channel(label)
+    else:
+        import flowkit as fk
+        ff = fk.Sample(file)
+        keep = [ff.pnn_labels.index(label) for label in columns]
+        out[:, :] = ff.get_orig_events()[:, keep]
+
+
+def _fill_events(file, key, cache_dir, columns, out_file, shape, start, end):
+    # worker of the parallel load, it attaches to the shared output and writes its rows only
+    x = np.memmap(out_file, dtype=np.float32, mode='r+', shape=shape)
+    _read_into(x[start:end], file, key, cache_dir, columns)
+    x.flush()
+
+
+def _open_shared(out_file, dtype, shape):
+    # reopen a filled output read-only, the backing file is kept while the array is alive
+    # (joblib passes memmaps to workers by path) and removed once it is released
+    x = np.memmap(out_file, dtype=dtype, mode='r', shape=shape)
+    weakref.finalize(x, shutil.rmtree, os.path.dirname(out_file), True)
+    return x
+
+
+def share_array(x):
+    """
+    This function publishes x once as a read-only memory-mapped file. joblib hands memmaps to its workers
+    by reference (file path), so every worker attaches to the same pages instead of unpickling its own copy.
+    Arrays that are already shared (e.g. the output of load_events with n_jobs != 1) are returned as is.
+    """
+    import tempfile
+    if isinstance(x, np.memmap) and x.mode == 'r':
+        return x
+    x = np.asarray(x)
+    out_file = os.path.join(tempfile.mkdtemp(dir=os.environ.get('JOBLIB_TEMP_FOLDER')), 'shared.dat')
+    shared = np.memmap(out_file, dtype=x.dtype, mode='w+', shape=x.shape)
+    shared[:] = x
+    shared.flush()
+    del shared
+    return _open_shared(out_file, x.dtype, x.shape)
+
+
+def shared_empty(shape, dtype=np.float32):
+    """
+    This function allocates a writable memory-mapped output. joblib workers that receive it attach to the same
+    file, so they can fill their part of it in place instead of sending results back through pickling.
+    """
+    import tempfile
+    out_file = os.path.join(tempfile.mkdtemp(dir=os.environ.get('JOBLIB_TEMP_FOLDER')), 'shared.dat')
+    x = np.memmap(out_file, dtype=dtype, mode='w+', shape=shape)
+    weakref.finalize(x, shutil.rmtree, os.path.dirname(out_file), True)
+    return x
+
+
+def load_events(files, exclude=(), cache_dir=CACHE_DIR, n_jobs=1):
+    """
+    This function loads the events of all files into one float32 matrix (n_events x n_channels), without
+    keeping a list of per-file matrices around. The event counts are read from the fcs headers (or the cache
+    schema) first, so the output is allocated once and filled file by file.
+    exclude: channels to leave out of the output (e.g. the non-phenotypic markers and NET)
+    cache_dir: columnar cache to read from (see ingest_fcs), if None the fcs files are parsed with flowkit
+    n_jobs: if not 1, the files are decoded in a process pool and each worker writes straight into
+            a shared (memory-mapped) output, which is returned read-only (see share_array)
+    Return:
+        x: float32 matrix of the events of all files, in the order of files
+        columns: names of the channels in x
+        counts: number of events of each file
+    """
+    if cache_dir is not None:
+        keys = ingest_fcs(files, cache_dir, n_jobs=n_jobs)
+        samples = [CachedSample(key, cache_dir) for key in keys]
+        counts = np.array([ff.event_count for ff in samples], dtype=np.int64)
+        pnn_labels = samples[0].pnn_labels
+    else:
+        keys = [None] * len(files)
+        counts = np.array([read_fcs_event_count(file) for file in files], dtype=np.int64)
+        pnn_labels = read_fcs_pnn_labels(files[0])
+    columns = [label for label in pnn_labels if label not in exclude]
+    shape = (int(counts.sum()), len(columns))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    if n_jobs == 1:
+        x = np.empty(shape, dtype=np.float32)
+        for k, file in enumerate(files):
+            _read_into(x[offsets[k]:offsets[k + 1]], file, keys[k], cache_dir, columns)
+    else:
+        import tempfile
+        from joblib import Parallel, delayed
+        out_file = os.path.join(tempfile.mkdtemp(dir=os.environ.get('JOBLIB_TEMP_FOLDER')), 'events.dat')
+        x = np.memmap(out_file, dtype=np.float32, mode='w+', shape=shape)
+        Parallel(n_jobs=n_jobs)(delayed(_fill_events)(file, keys[k], cache_dir, columns, out_file, shape,
+                                                      offsets[k], offsets[k + 1]) for k, file in enumerate(files))
+        x.flush()
+        x = _open_shared(out_file, x.dtype, shape)
+    return x, columns, counts
+
+
+def row_ranges(counts, keep):
+    """
+    This function gives the rows of the matrix of load_events that belong to the files selected by keep (one bool
+    per file), as (start, end) ranges where neighbouring files are merged, so a split of the cohort is a few slices
+    of it. counts: number of events of each file (as returned by load_events)
+    """
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    ranges = []
+    for k in np.where(keep)[0]:
+        if ranges and (ranges[-1][1] == offsets[k]):
+            ranges[-1] = (ranges[-1][0], int(offsets[k + 1]))
+        else:
+            ranges.append((int(offsets[k]), int(offsets[k + 1])))
+    return ranges
+
+
+class RowSlices:
+    """
+    the rows of x in several ranges (see row_ranges) as one read-only array without copying them: it has the shape,
+    dtype and len of their concatenation, and indexing it by a slice or an array of row numbers (what the training
+    and inference loops do) reads only those rows from the slices of x. np.asarray makes the concatenated copy
+    """
+    def __init__(self, x, ranges):
+        self.parts = [x[start:end] for start, end in ranges]
+        self.offsets = np.cumsum([0] + [part.shape[0] for part in self.parts])
+        self.shape = (int(self.offsets[-1]),) + x.shape[1:]
+        self.dtype = x.dtype
+        self.ndim = x.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.concatenate(self.parts).astype(dtype or self.dtype, copy=False)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.shape[0])
+            if step == 1:
+                # the part of each slice of x that falls in [start, stop)
+                rows = [part[max(start - offset, 0):max(stop - offset, 0)]
+                        for part, offset in zip(self.parts, self.offsets)]
+                rows = [part for part in rows if part.shape[0] > 0]
+                if len(rows) == 1:
+                    return rows[0] # a view of x
+                return np.concatenate(rows) if rows else np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            index = np.arange(start, stop, step)
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        flat = np.where(index < 0, index + self.shape[0], index).ravel()
+        out = np.empty((flat.shape[0],) + self.shape[1:], dtype=self.dtype)
+        which = np.searchsorted(self.offsets, flat, side='right') - 1
+        for k, part in enumerate(self.parts):
+            rows = which == k
+            if np.any(rows):
+                out[rows] = part[flat[rows] - self.offsets[k]]
+        return out.reshape(index.shape + self.shape[1:])
+
+
+def take_rows(x, ranges):
+    """
+    returns the rows of x in ranges (see row_ranges) without copying them: a view of x when it is a single slice,
+    otherwise a RowSlices over the slices of x
+    """
+    if len(ranges) == 1:
+        return x[ranges[0][0]:ranges[0][1]]
+    return RowSlices(x, ranges)
+
+
+def encode_samples(names, counts):
+    """
+    This function dictionary-encodes the sample identity of the events: one int32 code per event plus a
+    small lookup table (code -> sample name), instead of one sample name string per event.
+    names: sample name of each file, counts: number of events of each file (as returned by load_events)
+    """
+    codes = np.repeat(np.arange(len(names), dtype=np.int32), counts)
+    samples = pd.DataFrame({'code': np.arange(len(names), dtype=np.int32), 'sample': list(names)})
+    return codes, samples
+
+
+def decode_samples(codes, samples):
+    """
+    returns the sample names of the codes as a categorical (the codes are kept, names are stored once)
+    """
+    samples = samples.sort_values('code')
+    return pd.Categorical.from_codes(np.asarray(codes), categories=samples['sample'].to_numpy())
+
+
+def samples_file(file):
+    """
+    path of the lookup table that is written next to an exported file
+    """
+    return re.sub(r'\.csv$', '', file) + '_samples.csv'
+
+
+def to_exchange(to_R, samples, file):
+    """
+    This function writes an export for R (whose sample column holds codes), the format follows the extension of file:
+    .csv: text, with its lookup table written next to it (see samples_file)
+    .parquet or .feather: columnar (R: arrow::read_parquet / arrow::read_feather), the other columns keep their
+                          dtype (uint8 clusters, float32 hidden) and sample is dictionary-encoded with the sample
+                          names, so it is read as a factor and needs no lookup table
+    returns the files written
+    """
+    if file.endswith('.csv'):
+        to_R.to_csv(file)
+        samples.to_csv(samples_file(file), index=False)
+        return [file, samples_file(file)]
+    import pyarrow as pa
+    to_R = to_R.copy(deep=False)
+    to_R['sample'] = decode_samples(to_R['sample'], samples)
+    table = pa.Table.from_pandas(to_R.rename(columns=str), preserve_index=False)
+    if file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pq.write_table(table, file)
+    elif file.endswith('.feather'):
+        import pyarrow.feather as feather
+        feather.write_feather(table, file)
+    else:
+        raise ValueError('unknown export format of {}'.format(file))
+    return [file]
+
+
+def read_exchange(file):
+    """
+    This function reads an export of to_exchange in any of its formats.
+    Return:
+        to_R: the export, its sample column holds the codes
+        samples: lookup table of the codes
+    """
+    if file.endswith('.csv'):
+        return pd.read_csv(file, index_col=0), pd.read_csv(samples_file(file))
+    if file.endswith('.parquet'):
+        to_R = pd.read_parquet(file)
+    else:
+        to_R = pd.read_feather(file)
+    sample = to_R['sample'].astype('category')
+    samples = pd.DataFrame({'code': np.arange(len(sample.cat.categories), dtype=np.int32),
+                            'sample': list(sample.cat.categories)})
+    to_R['sample'] = sample.cat.codes.astype(np.int32)
+    return to_R, samples
@@ -0,0 +1,186 @@
+"""
+This script contains the engine that turns the clustered events into the per-sample feature tables of the ML scripts
+(the df_meanAllMarkers_<region>_noStd_exp2mc_5_13 tables of 5_R_postSynaptic_subtraction.R and
+6_R_clusterFeatures.R). The event count and the marker sums of every (sample, cluster) pair are scatter-added with
+np.bincount over the flat index sample*n_clusters + cluster in one pass over the events, so no per-event table is
+written, read back or grouped.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from glob import glob
+
+
+# names of the metaclusters 1..15 (as in the R scripts)
+CLUSTER_NAMES = ['C1', 'C10', 'C3', 'C4', 'B1', 'C5', 'C11', 'A1', 'C2', 'C7', 'C9', 'C6', 'B2', 'A2', 'C8']
+FUNCTIONAL = ['b-Amyloid_X40', 'b-Amyloid_X42', 'p-Tau', 'a-Synuclein_pS129',
+              'EAAT1', 'GFAP', 'Casp3_Acti', '3NT', 'LC3B', 'K48-Ubiquitin']
+# markers that should not exist in post-synaptic events, their post-synaptic mean is subtracted in B1 and B2
+ADJUST_MARKERS = ['CD47', 'DAT', 'a-Synuclein', 'VGLUT', 'GAD65', 'VMAT2', 'Synaptobrevin2']
+ADJUST_CLUSTERS = ['B1', 'B2']
+ODC_SAMPLES = ['HF14-017.fcs', 'HF14-083.fcs', 'HF14-025.fcs'] # LowNo samples that turned out not to be LowNo
+
+
+def cluster_sums(x, labels, codes, n_samples, n_clusters, chunk_size=2**14):
+    """
+    This function counts the events and sums the markers of every (sample, cluster) pair.
+    x: events (n_events x n_markers), labels: cluster index of each event (0..n_clusters-1),
+    codes: sample index of each event (0..n_samples-1, e.g. from utils_fcs.encode_samples)
+    Return:
+        counts: (n_samples x n_clusters) number of events
+        sums: (n_samples x n_clusters x n_markers) sum of each marker (float64)
+    """
+    counts = np.zeros(n_samples * n_clusters, dtype=np.int64)
+    sums = np.zeros((x.shape[1], n_samples * n_clusters))
+    # chunks of events small enough to stay in cache while every marker of them is added
+    for start in range(0, x.shape[0], chunk_size):
+        index = (np.asarray(codes[start:start + chunk_size], dtype=np.int64) * n_clusters +
+                 np.asarray(labels[start:start + chunk_size], dtype=np.int64))
+        chunk = np.asarray(x[start:start + chunk_size])
+        counts += np.bincount(index, minlength=n_samples * n_clusters)
+        for j in range(x.shape[1]):
+            sums[j] += np.bincount(index, weights=chunk[:, j], minlength=n_samples * n_clusters)
+    return counts.reshape(n_samples, n_clusters), sums.T.reshape(n_samples, n_clusters, x.shape[1])
+
+
+def cluster_means(counts, sums):
+    """
+    per (sample, cluster) marker means, NaN where the sample has no event in the cluster (like pivot_wider in R)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts[:, :, None]
+
+
+def r_sort(names, decreasing=False):
+    # R's sort collates case-insensitively (e.g. 'a-Synuclein' before 'Casp3'), unlike sorted
+    return sorted(names, key=lambda name: (name.lower(), name), reverse=decreasing)
+
+
+def cluster_order(clusters=CLUSTER_NAMES):
+    """
+    order of the cluster columns of the feature tables (as in 6_R_clusterFeatures.R)
+    """
+    clusters = r_sort(clusters)
+    return clusters[0:5] + clusters[7:15] + clusters[5:7]
+
+
+def post_reference(post_means, markers, clusters=CLUSTER_NAMES, adjust_markers=ADJUST_MARKERS,
+                   adjust_clusters=ADJUST_CLUSTERS):
+    """
+    This function gives the values subtracted from the pre-synaptic events (as in 5_R_postSynaptic_subtraction.R):
+    for each adjusted marker and cluster, the mean over the groups of the mean over the samples of its post-synaptic
+    mean (a group without any event in the cluster counts as 0).
+    post_means: dict of group -> (n_samples x n_clusters x n_markers) post-synaptic means of a region
+    Return:
+        (n_clusters x n_markers) values to subtract from the means, 0 for the markers and clusters not adjusted
+    """
+    ref = np.zeros((len(clusters), len(markers)))
+    for cluster in adjust_clusters:
+        k = clusters.index(cluster)
+        for marker in adjust_markers:
+            if marker not in markers:
+                continue
+            j = markers.index(marker)
+            group_means = [np.nanmean(means[:, k, j]) if np.any(~np.isnan(means[:, k, j])) else 0.0
+                           for means in post_means.values()]
+            ref[k, j] = np.mean(group_means)
+    return ref
+
+
+def feature_table(means, group, samples, markers, clusters=CLUSTER_NAMES):
+    """
+    This function lays out the means of one group as the rows of a feature table: group, sample and one column
+    <marker>_mean_<cluster> per marker (functional markers first, then the others) and cluster (see cluster_order),
+    the samples are sorted by name
+    """
+    functional = r_sort([m for m in markers if m in FUNCTIONAL])
+    surface = r_sort([m for m in markers if m not in FUNCTIONAL], decreasing=True)
+    order = cluster_order(clusters)
+    rows = np.argsort(samples, kind='stable')
+    columns = {'group': [group] * len(samples), 'sample': list(np.asarray(samples)[rows])}
+    for marker in functional + surface:
+        j = markers.index(marker)
+        for cluster in order:
+            columns[marker + '_mean_' + cluster] = means[rows, clusters.index(cluster), j]
+    return pd.DataFrame(columns)
+
+
+def freq_table(counts, group, samples, clusters=CLUSTER_NAMES):
+    """
+    This function lays out the event counts of one group as the rows of a frequency table like df_freq_<region> of
+    6_R_clusterFeatures.R: group, sample and one column per cluster (see cluster_order), the samples sorted by name.
+    as there, a cluster column is the share of the events of the sample only if every sample of the group has events
+    in it (the shares are out of these columns), otherwise it keeps the counts, NaN where the sample has none
+    """
+    order = [clusters.index(cluster) for cluster in cluster_order(clusters)]
+    rows = np.argsort(samples, kind='stable')
+    freq = np.where(counts > 0, counts, np.nan)[rows][:, order]
+    complete = ~np.any(np.isnan(freq), axis=0)
+    freq[:, complete] = freq[:, complete] / freq[:, complete].sum(axis=1, keepdims=True)
+    columns = {'group': [group] * len(samples), 'sample': list(np.asarray(samples)[rows])}
+    columns.update({cluster: freq[:, j] for j, cluster in enumerate(cluster_order(clusters))})
+    return pd.DataFrame(columns)
+
+
+def read_metaclusters(mc_file):
+    """
+    This function reads the metaclustering output of 4_R_metaClustering.R, whose rows are the events of each exported
+    file in a row (sample: <pre or post>_<region>_<group>_<batch>_<sample>).
+    Return:
+        labels: cluster index (0..14) of every event
+        rows: dict of sample -> (start, end) rows of its events
+    """
+    mc = pd.read_csv(mc_file, usecols=['mc', 'sample'], dtype={'mc': np.uint8, 'sample': 'category'})
+    codes = mc['sample'].cat.codes.to_numpy()
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+    ends = np.append(starts[1:], len(codes))
+    rows = {mc['sample'].cat.categories[codes[start]]: (start, end) for start, end in zip(starts, ends)}
+    return mc['mc'].to_numpy() - 1, rows
+
+
+def region_feature_tables(mc_file, regions=('BA9', 'DLCau', 'Hipp'), groups=('LowNo', 'LBD', 'PHAD'),
+                          fcs_path='../raw_data/max_events/fcs/', fcs_path_post='../raw_data/max_events/fcs_post_synap/',
+                          n_jobs=1):
+    """
+    This function computes the df_meanAllMarkers_<region>_noStd_exp2mc_5_13 and df_freq_<region>_noStd tables of every
+    region straight from the fcs files (through the columnar cache) and the metaclusters: per (sample, cluster)
+    marker means of the pre-synaptic events, minus the post-synaptic reference of the adjusted markers in B1 and B2,
+    and the cluster frequencies of the pre-synaptic events (from the same pass). the samples of ODC_SAMPLES are moved
+    from LowNo to their own ODC group (after the groups).
+    Return:
+        tables: dict of region -> feature table (see feature_table)
+        freq_tables: dict of region -> frequency table (see freq_table)
+    """
+    from utils_fcs import load_events
+    labels, rows = read_metaclusters(mc_file)
+    tables, freq_tables = {}, {}
+    for region in regions:
+        means = {'pre': {}, 'post': {}}
+        for pp, path in [('pre', fcs_path), ('post', fcs_path_post)]:
+            for group in groups:
+                files = np.sort(glob(path + region + '_' + group + '*.fcs'))
+                x, markers, counts = load_events(files, exclude=['NET'], n_jobs=n_jobs)
+                file_rows = [rows['_'.join([pp] + os.path.basename(file).split('_'))] for file in files]
+                if not np.array_equal([end - start for start, end in file_rows], counts):
+                    raise ValueError('the metaclusters of {} do not match its events'.format(pp + '_' + region + '_' + group))
+                file_labels = np.concatenate([labels[start:end] for start, end in file_rows])
+                codes = np.repeat(np.arange(len(files)), counts)
+                n_events, sums = cluster_sums(x, file_labels, codes, len(files), len(CLUSTER_NAMES))
+                means[pp][group] = (cluster_means(n_events, sums), np.array([file.split('_')[-1] for file in files]),
+                                    n_events)
+        # subtracting the reference from every event of a cluster subtracts it from the mean of the cluster
+        ref = post_reference({group: m for group, (m, samples, n_events) in means['post'].items()}, markers)
+        table, odc_table, freq, odc_freq = [], [], [], []
+        for group in groups:
+            m, samples, n_events = means['pre'][group]
+            m = m - ref
+            odc = np.isin(samples, ODC_SAMPLES) & (group == 'LowNo')
+            table.append(feature_table(m[~odc], group, samples[~odc], markers))
+            freq.append(freq_table(n_events[~odc], group, samples[~odc]))
+            if np.any(odc):
+                odc_table.append(feature_table(m[odc], 'ODC', samples[odc], markers))
+                odc_freq.append(freq_table(n_events[odc], 'ODC', samples[odc]))
+        tables[region] = pd.concat(table + odc_table, ignore_index=True)
+        freq_tables[region] = pd.concat(freq + odc_freq, ignore_index=True)
+    return tables, freq_tables
@@ -0,0 +1,241 @@
+"""
+This script contains a NumPy-only inference engine for trained megaAEs. The encoders and the cluster centers of a
+megaAE are exported to a .npz (see utils_test.export_npz), which is all that is needed to get the cluster labels and
+the hidden representation, so the inference workers neither import tensorflow nor rebuild the keras model.
+For the cluster assignment, the encoders can also run as an int8 tflite model (see quantize and QuantizedMegaAE).
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+HIDDEN_CACHE_DIR = '../results_ae/hidden_cache/' # default location of the cached hidden representations
+_npz_cache = {} # (path, mtime) -> NumpyMegaAE, (path, mtime, n_threads) -> QuantizedMegaAE
+_data_hashes = {} # (memmap file, address, shape, strides) -> hash of a read-only memmap
+
+
+class NumpyMegaAE:
+    """
+    forward pass of the inference part of a megaAE (the two encoders and the clustering layer) in float32.
+    predict mirrors the keras inference_model, it returns q (soft labels) and the concatenated hidden representation
+    """
+    def __init__(self, weights):
+        self.branches = []
+        for b in range(int(weights['n_branches'])):
+            n_layers = int(weights['branch%d_n_layers' % b])
+            self.branches.append([(weights['branch%d_kernel%d' % (b, j)].astype(np.float32),
+                                   weights['branch%d_bias%d' % (b, j)].astype(np.float32),
+                                   str(weights['branch%d_activation%d' % (b, j)])) for j in range(n_layers)])
+        self.clusters = weights['clusters'].astype(np.float32)
+        self.alpha = float(weights['alpha'])
+        self.clusters_sq = np.sum(np.square(self.clusters), axis=1)
+        self.n_clusters = self.clusters.shape[0]
+        self.n_hidden = self.clusters.shape[1]
+
+    def encode(self, x):
+        """
+        returns the concatenated hidden representation of x (n_events x n_hidden)
+        """
+        hidden = []
+        for layers in self.branches:
+            h = x
+            for kernel, bias, activation in layers:
+                h = h @ kernel
+                h += bias
+                if activation == 'relu':
+                    np.maximum(h, 0, out=h)
+                elif activation != 'linear':
+                    raise ValueError('activation {} is not supported'.format(activation))
+            hidden.append(h)
+        return np.concatenate(hidden, axis=1)
+
+    def soft_labels(self, hidden):
+        """
+        student t-distribution of the hidden representation to the cluster centers, as in ClusteringLayer
+        """
+        dist = np.sum(np.square(hidden), axis=1, keepdims=True) - 2 * (hidden @ self.clusters.T) + self.clusters_sq
+        q = 1.0 / (1.0 + np.maximum(dist, 0) / self.alpha)
+        q **= (self.alpha + 1.0) / 2.0
+        q /= q.sum(axis=1, keepdims=True)
+        return q
+
+    def predict(self, inputs, batch_size=2**13, verbose=0):
+        # inputs is [x, x] like the keras model (both encoders get the same events)
+        x = np.asarray(inputs[0], dtype=np.float32)
+        q = np.empty((x.shape[0], self.n_clusters), dtype=np.float32)
+        hidden = np.empty((x.shape[0], self.n_hidden), dtype=np.float32)
+        for start in range(0, x.shape[0], batch_size):
+            end = min(start + batch_size, x.shape[0])
+            hidden[start:end] = self.encode(x[start:end])
+            q[start:end] = self.soft_labels(hidden[start:end])
+        return q, hidden
+
+
+def npz_file(identifier, i, prefix='megaAE', save_dir='../results_ae'):
+    """
+    path of the exported weights of rep i, next to its .h5
+    """
+    return os.path.join(save_dir, prefix + '_' + identifier + '_' + str(i) + '.npz')
+
+
+def load_npz(path):
+    """
+    this function loads an exported megaAE once per process and reuses it while the file is unchanged
+    """
+    key = (path, os.stat(path).st_mtime)
+    if key not in _npz_cache:
+        with np.load(path) as weights:
+            _npz_cache[key] = NumpyMegaAE(weights)
+    return _npz_cache[key]
+
+
+def load_inference(identifier, i, prefix='megaAE', save_dir='../results_ae'):
+    """
+    this function returns the NumpyMegaAE of rep i. models saved before the .npz export existed are exported
+    once from their .h5 (this is the only case where tensorflow is imported)
+    """
+    path = npz_file(identifier, i, prefix, save_dir)
+    if not os.path.exists(path):
+        from utils_test import load_megaAE, export_npz
+        export_npz(load_megaAE(identifier, i, prefix, save_dir), path)
+    return load_npz(path)
+
+
+class QuantizedMegaAE(NumpyMegaAE):
+    """
+    NumpyMegaAE whose encoders run as the int8 tflite model of utils_test.export_tflite. the cluster centers stay
+    float32, so q (and the labels) are computed from the dequantized hidden as in the float model
+    """
+    def __init__(self, weights, tflite_file, n_threads=1):
+        super().__init__(weights)
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError: # the standalone runtime is not installed, use the one of tensorflow
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=tflite_file, num_threads=n_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_rows = None
+
+    def encode(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if x.shape[0] != self.batch_rows:
+            # the interpreter is resized only when the batch size changes (the last batch of a chunk)
+            self.interpreter.resize_tensor_input(self.input_index, list(x.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_rows = x.shape[0]
+        self.interpreter.set_tensor(self.input_index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+def quantized_file(identifier, i, prefix='megaAE', save_dir='../results_ae'):
+    """
+    path of the int8 encoder of rep i, next to its .h5
+    """
+    return os.path.join(save_dir, prefix + '_' + identifier + '_' + str(i) + '.tflite')
+
+
+def load_quantized(identifier, i, prefix='megaAE', save_dir='../results_ae', n_threads=1):
+    """
+    this function returns the QuantizedMegaAE of rep i (see quantize), it is loaded once per process
+    """
+    path = quantized_file(identifier, i, prefix, save_dir)
+    key = (path, os.stat(path).st_mtime, n_threads)
+    if key not in _npz_cache:
+        load_inference(identifier, i, prefix, save_dir) # exports the .npz if needed
+        with np.load(npz_file(identifier, i, prefix, save_dir)) as weights:
+            _npz_cache[key] = QuantizedMegaAE(weights, path, n_threads)
+    return _npz_cache[key]
+
+
+def label_agreement(model_a, model_b, x):
+    """
+    This function compares the cluster labels of two models on x.
+    Return:
+        dict of the share of events with the same label ('agreement') and the lowest share among the clusters of
+        model_a ('worst_cluster', clusters with less than 100 events are left out)
+    """
+    labels_a = np.empty(x.shape[0], dtype=np.uint8)
+    labels_b = np.empty(x.shape[0], dtype=np.uint8)
+    predict_chunked(model_a, x, cluster_out=labels_a)
+    predict_chunked(model_b, x, cluster_out=labels_b)
+    same = labels_a == labels_b
+    counts = np.bincount(labels_a)
+    per_cluster = np.bincount(labels_a, weights=same) / np.maximum(counts, 1)
+    return {'agreement': float(same.mean()), 'worst_cluster': float(per_cluster[counts >= 100].min(initial=1.0))}
+
+
+def quantize(identifier, i, x, prefix='megaAE', save_dir='../results_ae', n_calib=2**14, n_check=2**16, seed=0):
+    """
+    This function exports the int8 encoder of rep i (tensorflow is needed here), with the ranges of its activations
+    calibrated on n_calib random events of x, and reports the agreement of its labels with the float model on
+    n_check other events of x (see label_agreement, which is returned)
+    """
+    from utils_test import load_megaAE, export_tflite
+    index = np.random.RandomState(seed).permutation(x.shape[0])[:n_calib + n_check]
+    # sorted, so that a memory-mapped x is read front to back
+    calib, check = np.sort(index[:n_calib]), np.sort(index[n_calib:])
+    export_tflite(load_megaAE(identifier, i, prefix, save_dir), x[calib], quantized_file(identifier, i, prefix, save_dir))
+    agreement = label_agreement(load_inference(identifier, i, prefix, save_dir),
+                                load_quantized(identifier, i, prefix, save_dir), x[check])
+    print('int8 encoder of {} rep {}: labels agree on {:.2%} of {} events (worst cluster {:.2%})'.format(
+        identifier, i, agreement['agreement'], len(check), agreement['worst_cluster']))
+    return agreement
+
+
+def predict_chunked(model, x, cluster_out=None, hidden_out=None, chunk_size=2**17, batch_size=2**13):
+    """
+    this function runs an inference_model (or a NumpyMegaAE) over x in fixed-size chunks of events and writes the
+    labels and hidden representation of each chunk into cluster_out and hidden_out (e.g. columns of a memory-mapped
+    output) as soon as they are computed, so peak memory depends on chunk_size and not on the number of events
+    """
+    for start in range(0, x.shape[0], chunk_size):
+        end = min(start + chunk_size, x.shape[0])
+        x_chunk = np.asarray(x[start:end])
+        q, hidden = model.predict([x_chunk, x_chunk], batch_size=batch_size, verbose=0)
+        if cluster_out is not None:
+            cluster_out[start:end] = q.argmax(1)
+        if hidden_out is not None:
+            hidden_out[start:end] = hidden
+
+
+def data_hash(x, block_rows=2**16):
+    """
+    sha1 of the shape, dtype and content of x (read block by block), read-only memmaps are hashed once per process
+    """
+    key = None
+    if isinstance(x, np.memmap) and (x.mode == 'r'):
+        key = (x.filename, x.__array_interface__['data'][0], x.shape, x.strides)
+        if key in _data_hashes:
+            return _data_hashes[key]
+    h = hashlib.sha1(str((x.shape, str(x.dtype))).encode())
+    for start in range(0, x.shape[0], block_rows):
+        h.update(np.ascontiguousarray(x[start:start + block_rows]).tobytes())
+    if key is not None:
+        _data_hashes[key] = h.hexdigest()
+    return h.hexdigest()
+
+
+def hidden_cache(weights_files, x, encode, n_hidden, cache_dir=HIDDEN_CACHE_DIR, chunk_size=2**17):
+    """
+    This function returns encode(x), the hidden representation of x, as a read-only float32 memory-mapped array.
+    It is computed (chunk by chunk) only the first time: the result is stored in cache_dir under the hash of the
+    model (content of weights_files) and of the data, so any stage that needs the same hidden reads it back.
+    encode: function that maps a chunk of x to its hidden representation (n_events x n_hidden)
+    """
+    from utils_fcs import file_hash
+    model_hash = hashlib.sha1(''.join([file_hash(file) for file in weights_files]).encode()).hexdigest()
+    path = os.path.join(cache_dir, model_hash[:20] + '_' + data_hash(x)[:20] + '.npy')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp' + str(os.getpid()) + '.npy'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(x.shape[0], n_hidden))
+        for start in range(0, x.shape[0], chunk_size):
+            out[start:start + chunk_size] = encode(np.asarray(x[start:start + chunk_size]))
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
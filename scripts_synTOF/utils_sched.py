@@ -0,0 +1,107 @@
+"""
+This script contains a small scheduler for the rep-parallel stages (pretraining, clustering, prediction). The cores
+(and memory) of the machine are split into slots, every slot gets a fixed set of cores, and its tasks run with as many
+threads as it has cores, so nested parallelism (BLAS, tensorflow, joblib inside a task) neither oversubscribes the
+machine nor leaves cores idle when there are fewer tasks than cores.
+"""
+
+import os
+import numpy as np
+
+
+def available_cores():
+    """
+    returns the cores this process may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def available_memory():
+    """
+    returns the memory available for new allocations in bytes (MemAvailable), None if it is not known
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def plan_slots(n_tasks, task_memory=None, cores=None, memory=None):
+    """
+    This function splits cores into the slots that run tasks concurrently: one slot per task if there are enough
+    cores, fewer when task_memory (bytes needed by one task) times the slots would not fit in memory.
+    Return:
+        list of core sets (one per slot), the cores are spread as evenly as possible
+    """
+    cores = available_cores() if cores is None else list(cores)
+    memory = available_memory() if memory is None else memory
+    n_slots = max(1, min(n_tasks, len(cores)))
+    if (task_memory is not None) and (memory is not None):
+        n_slots = max(1, min(n_slots, int(memory // task_memory)))
+    return [[int(c) for c in slot] for slot in np.array_split(cores, n_slots)]
+
+
+def assign_lanes(sizes, n_lanes):
+    """
+    This function distributes tasks of the given sizes over n_lanes, largest first to the least loaded lane
+    (so that all lanes finish at about the same time). returns the task indices of each lane
+    """
+    lanes = [[] for _ in range(n_lanes)]
+    load = np.zeros(n_lanes)
+    for k in np.argsort(-np.asarray(sizes, dtype=float), kind='stable'):
+        lane = int(np.argmin(load))
+        lanes[lane].append(int(k))
+        load[lane] += sizes[k]
+    return lanes
+
+
+def set_tf_threads(n_threads):
+    """
+    This function sets the intra-op threads of tensorflow to n_threads. tensorflow fixes them when it initializes, so
+    this raises if the process already initialized tensorflow with another number of threads
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+
+
+def _run_lane(func, lane, cores):
+    # worker side: pin this process to the cores of its slot and cap every thread pool to them
+    from threadpoolctl import threadpool_limits
+    n_threads = len(cores)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    with threadpool_limits(limits=n_threads):
+        return [(k, func(*args, n_threads=n_threads)) for k, args in lane]
+
+
+def run_scheduled(func, tasks, sizes=None, task_memory=None, cores=None, memory=None):
+    """
+    This function runs func(*args, n_threads=...) for every args in tasks and returns the results in the order of
+    tasks. tasks are spread over the slots of plan_slots, each slot is one fresh worker pinned to its cores, which runs
+    its tasks one after the other; n_threads tells func how many threads it may use (its cores). the workers are not
+    reused across calls, since tensorflow keeps the threads of the first task a worker ran.
+    sizes: relative cost of each task (for balancing the slots), task_memory: bytes needed by one task
+    """
+    from joblib.externals.loky import get_reusable_executor
+    slots = plan_slots(len(tasks), task_memory, cores, memory)
+    sizes = np.ones(len(tasks)) if sizes is None else sizes
+    lanes = [[(k, tasks[k]) for k in lane] for lane in assign_lanes(sizes, len(slots))]
+    print('Running {} tasks on {} slots of {} cores'.format(len(tasks), len(slots), [len(slot) for slot in slots]))
+    # reuse=False replaces the workers of an earlier plan (whose tensorflow threads are already fixed)
+    executor = get_reusable_executor(max_workers=len(slots), reuse=False)
+    try:
+        results = [future.result() for future in [executor.submit(_run_lane, func, lane, slot)
+                                                  for lane, slot in zip(lanes, slots)]]
+    finally:
+        executor.shutdown(wait=True)
+    out = [None] * len(tasks)
+    for lane in results:
+        for k, result in lane:
+            out[k] = result
+    return out
@@ -5,7 +5,10 @@ import tensorflow.keras.backend as K
 from tensorflow.keras.initializers import glorot_uniform
 from tensorflow.keras.layers import Input, Dense, Layer, InputSpec, Activation
 from tensorflow.keras.models import Model
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras import activations
 from sklearn.cluster import KMeans
+from utils_infer import predict_chunked
 
 def reproducibility(seed_value=1, cpu=True):
     """
@@ -78,7 +81,11 @@ class ClusteringLayer(Layer):
         Return:
             q: student's t-distribution, or soft labels for each sample. shape=(n_samples, n_clusters)
         """
-        q = 1.0 / (1.0 + (K.sum(K.square(K.expand_dims(inputs, axis=1) - self.clusters), axis=2) / self.alpha))
+        # squared distances as ||x||^2 - 2 x.u + ||u||^2, i.e. one matmul instead of a (n_samples, n_clusters, n_features)
+        # difference tensor, clipped at 0 since the expansion can go slightly negative from rounding
+        dist = K.sum(K.square(inputs), axis=1, keepdims=True) - 2.0 * K.dot(inputs, K.transpose(self.clusters)) \
+               + K.expand_dims(K.sum(K.square(self.clusters), axis=1), axis=0)
+        q = 1.0 / (1.0 + (K.maximum(dist, 0.0) / self.alpha))
         q **= (self.alpha + 1.0) / 2.0
         q = K.transpose(K.transpose(q) / K.sum(q, axis=1))
         return q
@@ -93,6 +100,64 @@ class ClusteringLayer(Layer):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+def inference_model(megaAE):
+    """
+    this function builds the inference part of a trained megaAE: the two encoders and the clustering layer only,
+    the decoders are left out of the graph. outputs are q (soft labels) and the concatenated hidden representation
+    """
+    layer_names = [layer.name for layer in megaAE.layers]
+    concat_ind = np.max(np.where(['concatenate' in layer for layer in layer_names]))
+    hidden = megaAE.get_layer(name=layer_names[concat_ind]).output
+    return Model(inputs=megaAE.input, outputs=[megaAE.get_layer(name='clustering').output, hidden])
+
+
+def export_npz(megaAE, file):
+    """
+    this function exports the encoders and the cluster centers of a trained megaAE to a .npz that utils_infer
+    can run without tensorflow (the decoders are not exported)
+    """
+    layer_names = [layer.name for layer in megaAE.layers]
+    concat_ind = np.max(np.where(['concatenate' in layer for layer in layer_names]))
+    concat = megaAE.get_layer(name=layer_names[concat_ind])
+    clustering = megaAE.get_layer(name='clustering')
+    weights = {'n_branches': len(concat.input), 'clusters': clustering.get_weights()[0],
+               'alpha': clustering.alpha}
+    # each input of the concatenate is the hidden layer of one encoder, whose Dense layers come in order
+    for b, h in enumerate(concat.input):
+        layers = [layer for layer in Model(inputs=megaAE.input, outputs=h).layers if isinstance(layer, Dense)]
+        weights['branch%d_n_layers' % b] = len(layers)
+        for j, layer in enumerate(layers):
+            kernel, bias = layer.get_weights()
+            weights['branch%d_kernel%d' % (b, j)] = kernel
+            weights['branch%d_bias%d' % (b, j)] = bias
+            weights['branch%d_activation%d' % (b, j)] = layer.activation.__name__
+    np.savez(file, **weights)
+
+
+def export_tflite(megaAE, x_calib, file, batch_size=2**8):
+    """
+    this function exports the encoders of a trained megaAE as an int8 tflite model (post-training quantization of the
+    weights and activations, whose ranges are calibrated on the events of x_calib), input and output stay float32.
+    the clustering layer is not part of it, utils_infer.QuantizedMegaAE assigns the clusters from its hidden
+    """
+    import tensorflow as tf
+    layer_names = [layer.name for layer in megaAE.layers]
+    concat_ind = np.max(np.where(['concatenate' in layer for layer in layer_names]))
+    encoder = Model(inputs=megaAE.input, outputs=megaAE.get_layer(name=layer_names[concat_ind]).output)
+    # one input for both encoders, they get the same events
+    x_in = Input(shape=(x_calib.shape[1],))
+    encoder = Model(inputs=x_in, outputs=encoder([x_in, x_in]))
+    def representative_dataset():
+        for start in range(0, x_calib.shape[0], batch_size):
+            yield [np.asarray(x_calib[start:start + batch_size], dtype=np.float32)]
+    converter = tf.lite.TFLiteConverter.from_keras_model(encoder)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(file, 'wb') as f:
+        f.write(converter.convert())
+
+
 def autoencoder_(dims, act='relu', uniqueID = '0', l2=False, init='glorot_uniform', noise=False, dropout=False):
         """define a function for automated building of an AE given
         dims: a list containing number of nodes in each layer (length of list = number of layers)
@@ -123,6 +188,277 @@ def autoencoder_(dims, act='relu', uniqueID = '0', l2=False, init='glorot_unifor
         return Model(inputs=x, outputs=h)
 
 
+def index_batches(n, batch_size=2**10, seed=None):
+    """
+    this function streams batches of event indices (out of n events), a new random permutation of the events every
+    epoch. each epoch is batched on its own (its last batch is smaller), so steps_per_epoch batches are exactly one
+    pass over the events, like a keras epoch. the indices of a batch are sorted, so that gathering them reads the
+    events front to back. the stream is endless
+    """
+    import tensorflow as tf
+    ds = tf.data.Dataset.range(1).repeat().flat_map(
+        lambda _: tf.data.Dataset.from_tensor_slices(tf.random.shuffle(tf.range(n, dtype=tf.int64), seed=seed)).batch(batch_size))
+    return ds.map(tf.sort)
+
+
+def gather_rows(x, index):
+    """
+    this function returns the rows index of x as a float32 tensor inside a tf.data pipeline. the rows are read from x
+    (e.g. a read-only memmap shared by the workers) batch by batch, so x is never copied whole into tensorflow
+    """
+    import tensorflow as tf
+    rows = tf.numpy_function(lambda i: np.asarray(x[i], dtype=np.float32), [index], tf.float32)
+    rows.set_shape(index.shape.concatenate([x.shape[1]]))
+    return rows
+
+
+def predict_rows(f, x, chunk_size=2**16):
+    """
+    returns f(x_chunk) over x in chunks of events, concatenated (f maps a float32 array to a numpy array)
+    """
+    return np.concatenate([f(np.asarray(x[start:start + chunk_size], dtype=np.float32))
+                           for start in range(0, x.shape[0], chunk_size)])
+
+
+def event_dataset(x, batch_size=2**10, seed=None):
+    """
+    this function streams x as (x, x) batches for training an autoencoder: a new random permutation of the events
+    every epoch, each batch is read from x inside the pipeline (see gather_rows) and prefetched while the previous
+    one trains. the stream is endless, so fit needs steps_per_epoch (see steps_per_epoch)
+    """
+    import tensorflow as tf
+    def gather(index):
+        rows = gather_rows(x, index)
+        return rows, rows
+    ds = index_batches(x.shape[0], batch_size, seed).map(gather, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def steps_per_epoch(x, batch_size=2**10):
+    return int(np.ceil(x.shape[0] / batch_size))
+
+
+class EpochThroughput(Callback):
+    """
+    reports the number of events per second of each training epoch
+    """
+    def __init__(self, n_events, name=''):
+        super(EpochThroughput, self).__init__()
+        self.n_events = n_events
+        self.name = name
+
+    def on_epoch_begin(self, epoch, logs=None):
+        import time
+        self.start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        import time
+        elapsed = time.time() - self.start
+        print('{} epoch {}: {:.1f}s, {:.0f} events/s'.format(self.name, epoch + 1, elapsed, self.n_events / elapsed))
+
+
+# ensemble of replicas -------------------------------------------------------------------------------------
+class EnsembleDense(Layer):
+    """
+    n_reps independent Dense layers evaluated as one batched matmul. the kernel is (n_reps, input_dim, units) and
+    the output is (n_reps, batch, units), replica-major so that each replica is one contiguous GEMM; the input is
+    (n_reps, batch, input_dim), one batch per replica, or a 2-D input (batch, input_dim) fed to every replica.
+    each replica is initialized with glorot_normal of its own seed
+    """
+    def __init__(self, units, n_reps, activation=None, seeds=None, **kwargs):
+        super(EnsembleDense, self).__init__(**kwargs)
+        self.units = units
+        self.n_reps = n_reps
+        self.activation = activations.get(activation)
+        self.seeds = list(seeds) if seeds is not None else list(range(n_reps))
+
+    def build(self, input_shape):
+        import tensorflow as tf
+        from tensorflow.keras.initializers import glorot_normal
+        input_dim = input_shape[-1]
+        def init(shape, dtype=None):
+            return tf.stack([glorot_normal(seed=seed)((input_dim, self.units)) for seed in self.seeds])
+        self.kernel = self.add_weight(shape=(self.n_reps, input_dim, self.units), initializer=init, name='kernel')
+        self.bias = self.add_weight(shape=(self.n_reps, self.units), initializer='zeros', name='bias')
+        self.built = True
+
+    def call(self, inputs, **kwargs):
+        import tensorflow as tf
+        if len(inputs.shape) == 2:
+            inputs = inputs[None]
+        return self.activation(tf.matmul(inputs, self.kernel) + self.bias[:, None, :])
+
+    def get_config(self):
+        config = {'units': self.units, 'n_reps': self.n_reps, 'seeds': self.seeds,
+                  'activation': activations.serialize(self.activation)}
+        base_config = super(EnsembleDense, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def ensemble_autoencoder(dims, seeds, act='relu', uniqueID='0'):
+    """
+    the autoencoder_ architecture for len(seeds) replicas trained together (one replica per seed). layers have the
+    same names as in autoencoder_, the input is (n_reps, batch, dims[0]), one batch of events per replica, and the
+    output is (n_reps, batch, dims[0]) so the model is called directly (see fit_ensemble) rather than through
+    fit/predict
+    """
+    n_stacks = len(dims) - 1
+    n_reps = len(seeds)
+    x = Input(shape=(None, dims[0]), name='input' + uniqueID)
+    h = x
+    for i in range(n_stacks-1):
+        h = EnsembleDense(dims[i + 1], n_reps, activation=act, seeds=seeds, name='encoder_' + uniqueID + '%d' % i)(h)
+    h = EnsembleDense(dims[-1], n_reps, seeds=seeds, name='encoder_' + uniqueID + '%d' % (n_stacks - 1))(h)
+    for i in range(n_stacks-1, 0, -1):
+        h = EnsembleDense(dims[i], n_reps, activation=act, seeds=seeds, name='decoder_' + uniqueID + '%d' % i)(h)
+    h = EnsembleDense(dims[0], n_reps, seeds=seeds, name='decoder_' + uniqueID + '0')(h)
+    return Model(inputs=x, outputs=h)
+
+
+def fit_ensemble(model, x, epochs=20000, batch_size=2**10, learning_rate=0.1, min_delta=0.0025, patience=1,
+                 seeds=None, name=''):
+    """
+    this function trains an ensemble_autoencoder with mse (Adagrad, as in pretrain). every replica has its own
+    early stopping on its epoch r_square (like EarlyStopping(monitor='r_square', min_delta, patience)), a replica
+    that stopped is frozen (its gradients are masked) while the others keep training.
+    seeds: one per replica, each replica sees the events in its own order (its own permutation every epoch, as a
+    separately trained rep would), the batches of all replicas are gathered from x together
+    returns the epoch at which each replica stopped
+    """
+    import time
+    import tensorflow as tf
+    n_reps = model.get_layer(index=-1).n_reps
+    seeds = list(range(n_reps)) if seeds is None else list(seeds)
+    optimizer = tf.keras.optimizers.Adagrad(learning_rate=learning_rate)
+    active = tf.Variable(tf.ones(n_reps), trainable=False)
+    # (n_reps, batch) indices, one stream per replica, and the (n_reps, batch, features) events they point to
+    ds = tf.data.Dataset.zip(tuple(index_batches(x.shape[0], batch_size, seed) for seed in seeds))
+    ds = ds.map(lambda *index: gather_rows(x, tf.stack(index)), num_parallel_calls=tf.data.AUTOTUNE)
+    batches = iter(ds.prefetch(tf.data.AUTOTUNE))
+    steps = steps_per_epoch(x, batch_size)
+
+    @tf.function
+    def train_step(x_batch):
+        with tf.GradientTape() as tape:
+            x_hat = model(x_batch, training=True)
+            # (n_reps, batch, features) -> one mse per replica, their sum leaves each replica's gradient unchanged
+            mse = tf.reduce_mean(tf.square(x_batch - x_hat), axis=[1, 2])
+            loss = tf.reduce_sum(mse)
+        grads = tape.gradient(loss, model.trainable_variables)
+        # replicas are the leading axis of every weight, stopped ones get no update
+        grads = [g * tf.reshape(active, [-1] + [1] * (len(g.shape) - 1)) for g in grads]
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        ss_tot = tf.reduce_sum(tf.square(x_batch - tf.reduce_mean(x_batch, axis=[1, 2], keepdims=True)), axis=[1, 2])
+        ss_res = tf.reduce_sum(tf.square(x_batch - x_hat), axis=[1, 2])
+        return mse, 1 - ss_res / (ss_tot + K.epsilon())
+
+    @tf.function
+    def train_epoch():
+        mse, r2 = tf.zeros(n_reps), tf.zeros(n_reps)
+        for _ in tf.range(steps):
+            batch_mse, batch_r2 = train_step(next(batches))
+            mse += batch_mse
+            r2 += batch_r2
+        return mse / steps, r2 / steps
+
+    best = np.full(n_reps, -np.inf)
+    wait = np.zeros(n_reps, dtype=int)
+    stopped = np.full(n_reps, epochs)
+    for epoch in range(epochs):
+        start = time.time()
+        mse, r2 = [v.numpy() for v in train_epoch()]
+        elapsed = time.time() - start
+        print('{} epoch {}: {:.1f}s, {:.0f} events/s, {} replicas training, r_square {}'.format(
+            name, epoch + 1, elapsed, x.shape[0] / elapsed, int(active.numpy().sum()),
+            ['{:.4f}'.format(r) for r in r2]))
+        for r in np.where(active.numpy() > 0)[0]:
+            if r2[r] - min_delta > best[r]:
+                best[r], wait[r] = r2[r], 0
+            else:
+                wait[r] += 1
+                if wait[r] >= patience:
+                    stopped[r] = epoch + 1
+        active.assign((stopped == epochs).astype(np.float32))
+        if active.numpy().sum() == 0:
+            break
+    return stopped
+
+
+def export_ensemble(model, dims, files, uniqueID='0'):
+    """
+    this function writes replica r of an ensemble_autoencoder to files[r] as the weights of a plain
+    autoencoder_(dims, uniqueID) (i.e. the same file that pretrain saves for that rep)
+    """
+    for r, file in enumerate(files):
+        ae = autoencoder_(dims, uniqueID=uniqueID)
+        for layer in ae.layers:
+            if isinstance(layer, Dense):
+                kernel, bias = model.get_layer(name=layer.name).get_weights()
+                layer.set_weights([kernel[r], bias[r]])
+        ae.save_weights(file)
+
+
+# model registry -----------------------------------------------------------------------------------------
+# saved models are named <prefix>_<identifier>_<rep>.h5 (prefix is ae1, ae3, megaAE, ...) in save_dir
+_rep_index = {}   # (save_dir, prefix, identifier) -> (mtime of save_dir, {rep: path})
+_model_cache = {} # (path, mtime, ...) -> built model with its weights loaded
+
+def rep_files(identifier, prefix='ae1', save_dir='../results_ae'):
+    """
+    this function indexes the saved models of identifier by rep number. unlike glob(...)[i] it is sorted
+    numerically (rep 10 comes after rep 2) and does not pick up identifiers that only start with identifier.
+    the index is kept until save_dir changes
+    """
+    import os
+    import re
+    mtime = os.stat(save_dir).st_mtime
+    key = (os.path.abspath(save_dir), prefix, identifier)
+    if (key not in _rep_index) or (_rep_index[key][0] != mtime):
+        pattern = re.compile(re.escape(prefix + '_' + identifier) + r'_(\d+)\.h5$')
+        files = {}
+        for file in os.listdir(save_dir):
+            match = pattern.match(file)
+            if match:
+                files[int(match.group(1))] = os.path.join(save_dir, file)
+        _rep_index[key] = (mtime, dict(sorted(files.items())))
+    return _rep_index[key][1]
+
+
+def load_pretrained(identifier, dims_a, dims_b, i, save_dir='../results_ae', cache=True):
+    """
+    this function returns the pretrained ae1 and ae3 of rep i (built and with weights loaded). models are reused
+    across calls unless cache=False, which should be used when the models are going to be trained further
+    """
+    import os
+    paths = (rep_files(identifier, 'ae1', save_dir)[i], rep_files(identifier, 'ae3', save_dir)[i])
+    key = paths + tuple(os.stat(path).st_mtime for path in paths) + (tuple(dims_a), tuple(dims_b))
+    if cache and (key in _model_cache):
+        return _model_cache[key]
+    ae1 = autoencoder_(dims_a, uniqueID='0')
+    ae3 = autoencoder_(dims_b, uniqueID='2')
+    ae1.load_weights(paths[0])
+    ae3.load_weights(paths[1])
+    if cache:
+        _model_cache[key] = (ae1, ae3)
+    return ae1, ae3
+
+
+def load_megaAE(identifier, i, prefix='megaAE', save_dir='../results_ae', cache=True):
+    """
+    this function returns the trained megaAE of rep i, loaded once per process and reused by later calls
+    (cache=False gives a fresh copy, e.g. to train it further)
+    """
+    import os
+    from tensorflow.keras.models import load_model
+    path = rep_files(identifier, prefix, save_dir)[i]
+    if not cache:
+        return load_model(path, custom_objects={'ClusteringLayer': ClusteringLayer})
+    key = (path, os.stat(path).st_mtime)
+    if key not in _model_cache:
+        _model_cache[key] = load_model(path, custom_objects={'ClusteringLayer': ClusteringLayer})
+    return _model_cache[key]
+
+
 def clustering2K(model, encoder, x, y=None,
                    tol=1e-3,
                    k_seed=None,
@@ -174,85 +510,331 @@ def clustering2K(model, encoder, x, y=None,
         return y_pred
 
 
+
+def clustering2K_compiled(model, encoder, x, y=None,
+                          tol=1e-3,
+                          k_seed=None,
+                          update_interval=140,
+                          maxiter=2e4,
+                          batch_size=256,
+                          n_clusters=15,
+                          loss_weights=(0.5, 1/4, 1/4),
+                          jit_compile=True,
+                          check_size=None,
+                          confidence=0.95,
+                          adaptive=False,
+                          kmeans_init=True,
+                          snapshot=None,
+                          snapshot_every=1):
+        """
+        same training as clustering2K (KLD on the clustering output and MSE on the two decoders, weighted by
+        loss_weights, stopped when delta_label < tol) but the training step is a compiled tf.function, fed by
+        a prefetching tf.data pipeline of shuffled event indices. each batch of events is read from x in the pipeline
+        (x, e.g. a shared memmap, is never copied whole into tensorflow) and p stays in the graph.
+        model must be compiled (its optimizer is used)
+        check_size: if given, delta_label is estimated on a fixed stratified sample of check_size events (strata are
+                    the k-means clusters) instead of a full pass over x, and training stops once its upper confidence
+                    bound (at the confidence level) is below tol. the full refresh of p only runs when the sampled
+                    labels moved by tol or more since the last refresh, and once more at the end for the returned labels
+        adaptive: if True, the interval between checks doubles while labels settle (delta < 2*tol) and halves again
+                  while they change fast (delta > 4*tol), within update_interval and update_interval*4 (so p is
+                  never refreshed more often than with the fixed interval)
+        kmeans_init: if False, the cluster centers the model already has are kept (warm start from a trained
+                     megaAE, n_clusters is then taken from the model) and maxiter bounds the fine-tuning
+        snapshot: if given (a path prefix), the weights, optimizer state, p and the loop state are saved there every
+                  snapshot_every training blocks, and a run that finds a snapshot continues from it instead of
+                  starting over. the snapshot is removed once training has finished
+        """
+        import os
+        import time
+        import tensorflow as tf
+        print('Update interval', update_interval)
+        q_model = Model(inputs=model.input, outputs=model.get_layer(name='clustering').output)
+        state_file = None if snapshot is None else snapshot + '_state.npz'
+        resume = (state_file is not None) and os.path.exists(state_file)
+        if resume:
+            # the cluster centers (and everything else) come from the snapshot
+            n_clusters = model.get_layer(name='clustering').n_clusters
+            state = dict(np.load(state_file))
+            y_pred = state['y_pred_last']
+        elif kmeans_init:
+            # initialize cluster centers using k-means
+            print('Initializing cluster centers with k-means.')
+            kmeans = KMeans(n_clusters=n_clusters, random_state=k_seed, n_init=5)
+            y_pred = kmeans.fit_predict(predict_rows(lambda x_chunk: encoder.predict_on_batch([x_chunk, x_chunk]), x))
+            model.get_layer(name='clustering').set_weights([kmeans.cluster_centers_])
+        else:
+            print('Continuing from the current cluster centers.')
+            n_clusters = model.get_layer(name='clustering').n_clusters
+            y_pred = predict_rows(lambda x_chunk: q_model.predict_on_batch([x_chunk, x_chunk]), x).argmax(1)
+        y_pred_last = y_pred
+        n = x.shape[0]
+        p_tf = tf.Variable(tf.zeros((n, n_clusters)), trainable=False)
+        optimizer = model.optimizer
+        if snapshot is not None:
+            ckpt = tf.train.Checkpoint(model=model, optimizer=optimizer, p=p_tf)
+            if resume:
+                # optimizer slots are restored when they are created by the first step
+                ckpt.read(str(state['ckpt'])).expect_partial()
+                print('Resuming from snapshot {} at ite {}'.format(snapshot, int(state['ite'])))
+        w_kld, w_a, w_b = [tf.constant(w, dtype=tf.float32) for w in loss_weights]
+        # endless stream of (indices, events) batches, the events are read from x in the pipeline (see gather_rows)
+        ds = index_batches(n, batch_size, k_seed).map(lambda index: (index, gather_rows(x, index)),
+                                                      num_parallel_calls=tf.data.AUTOTUNE)
+        batches = iter(ds.prefetch(tf.data.AUTOTUNE))
+
+        @tf.function(jit_compile=jit_compile)
+        def train_step(x_batch, p_batch):
+            with tf.GradientTape() as tape:
+                q, x_a, x_b = model([x_batch, x_batch], training=True)
+                losses = [tf.reduce_mean(tf.keras.losses.kld(p_batch, q)),
+                          tf.reduce_mean(tf.keras.losses.mse(x_batch, x_a)),
+                          tf.reduce_mean(tf.keras.losses.mse(x_batch, x_b))]
+                loss = w_kld*losses[0] + w_a*losses[1] + w_b*losses[2]
+            grads = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return tf.stack([loss] + losses)
+
+        @tf.function
+        def train_steps(n_steps):
+            # runs n_steps training steps in the graph, returns the losses of the last one
+            loss = tf.zeros(4)
+            for _ in tf.range(n_steps):
+                index, x_batch = next(batches)
+                loss = train_step(x_batch, tf.gather(p_tf, index))
+            return loss
+
+        @tf.function
+        def predict_q(x_batch):
+            return q_model([x_batch, x_batch], training=False)
+
+        def update_target():
+            # full pass for q, then the auxiliary target distribution p (in the graph, p never leaves it)
+            q = tf.concat([predict_q(np.asarray(x[start:start + 2**16], dtype=np.float32))
+                           for start in range(0, n, 2**16)], axis=0)
+            weight = q ** 2 / tf.reduce_sum(q, axis=0)
+            p_tf.assign(weight / tf.reduce_sum(weight, axis=1, keepdims=True))
+            return q.numpy().argmax(1)
+
+        def save_snapshot():
+            # the checkpoint is written first under a new name, the state that points to it is then replaced, so a
+            # crash while saving leaves the previous snapshot usable
+            prefix = snapshot + '_ckpt_' + str(ite)
+            os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+            ckpt.write(prefix)
+            arrays = {'ite': ite, 'interval': interval, 'ckpt': prefix, 'y_pred_last': y_pred_last}
+            if check_size is not None:
+                arrays.update({'check_index': check_index, 'strata': strata, 'strata_w': strata_w,
+                               'check_last': check_last, 'check_refresh': check_refresh})
+            np.savez(state_file + '.tmp.npz', **arrays)
+            os.replace(state_file + '.tmp.npz', state_file)
+            remove_snapshot(keep=prefix)
+
+        def remove_snapshot(keep=None):
+            from glob import glob
+            for file in glob(snapshot + '_ckpt_*'):
+                if (keep is None) or (not file.startswith(keep + '.')):
+                    os.remove(file)
+            if (keep is None) and os.path.exists(state_file):
+                os.remove(state_file)
+
+        loss = [0, 0, 0, 0]
+        ite = 0
+        interval = update_interval
+        start_time = time.time()
+        if check_size is not None:
+            from scipy.stats import norm
+            z = norm.ppf(confidence)
+            if resume:
+                check_index, strata, strata_w = state['check_index'], state['strata'], state['strata_w']
+                check_last, check_refresh = state['check_last'], state['check_refresh']
+            else:
+                check_index, strata, strata_w = stratified_reservoir(y_pred, check_size, seed=k_seed)
+            check_x = tf.constant(np.asarray(x[check_index], dtype=np.float32))
+        if resume:
+            ite, interval = int(state['ite']), int(state['interval'])
+            ite_start = ite # steps/s is counted from the resume
+        else:
+            ite_start = 0
+        n_blocks = 0
+        while ite < int(maxiter):
+            if (check_size is None) or (ite == 0):
+                y_pred = update_target()
+                n_labels = len(np.unique(y_pred))
+                delta_label = np.sum(y_pred != y_pred_last).astype(np.float32) / y_pred.shape[0]
+                delta_bound = delta_label
+                y_pred_last = y_pred
+                if check_size is not None:
+                    check_last = check_refresh = y_pred[check_index]
+            else:
+                check_pred = predict_q(check_x).numpy().argmax(1)
+                n_labels = len(np.unique(check_pred))
+                delta_label, delta_bound = sampled_delta(check_pred != check_last, strata, strata_w, z)
+                check_last = check_pred
+                # p only needs a refresh when the labels moved away from the ones it was computed with
+                if (delta_bound >= tol) and (sampled_delta(check_pred != check_refresh, strata, strata_w, z)[0] >= tol):
+                    y_pred = update_target()
+                    check_refresh = check_pred
+                    print('Refreshed p at ite {}'.format(ite))
+            # the delta printed is the one the stop decision uses (the upper bound of the sampled estimate)
+            print('At ite {}, there are {} clusters, loss is {}, and delta is {:.4f} ({:.0f} steps/s)'.format(
+                ite, n_labels, ['{:.2f}'.format(l) for l in loss], delta_bound,
+                (ite - ite_start) / max(time.time() - start_time, 1e-9)))
+            # check stop criterion
+            if ite > 0 and delta_bound < tol:
+                print('delta_label ', delta_bound, '< tol ', tol)
+                print('Reached tolerance threshold. Stopping training.')
+                if check_size is not None:
+                    y_pred = update_target()
+                break
+            if adaptive and (ite > 0):
+                if delta_label > 4*tol:
+                    interval = max(interval // 2, update_interval)
+                elif delta_label < 2*tol:
+                    interval = min(interval * 2, update_interval * 4)
+            n_steps = min(interval, int(maxiter) - ite)
+            loss = train_steps(tf.constant(n_steps)).numpy()
+            ite += n_steps
+            n_blocks += 1
+            if (snapshot is not None) and (n_blocks % snapshot_every == 0) and (ite < int(maxiter)):
+                save_snapshot()
+        if snapshot is not None:
+            remove_snapshot()
+        return y_pred
+
+def stratified_reservoir(labels, size, seed=None):
+    """
+    this function draws a fixed sample of about size events, stratified by labels (proportional allocation
+    with at least one event per label). returns the sampled indices, their stratum and the weight of each
+    stratum (its share of all events)
+    """
+    rng = np.random.RandomState(seed)
+    strata_ids, counts = np.unique(labels, return_counts=True)
+    n_draw = np.minimum(counts, np.maximum(1, np.round(size * counts / counts.sum()).astype(int)))
+    index = np.concatenate([rng.choice(np.where(labels == k)[0], n, replace=False) for k, n in zip(strata_ids, n_draw)])
+    strata = np.repeat(np.arange(len(strata_ids)), n_draw)
+    return index, strata, counts / counts.sum()
+
+
+def sampled_delta(changed, strata, strata_w, z=1.96):
+    """
+    this function estimates the fraction of changed labels from a stratified sample (changed: boolean per sampled
+    event) and returns the estimate and its upper confidence bound (normal approximation, z standard errors)
+    """
+    n = np.bincount(strata, minlength=len(strata_w))
+    d = np.bincount(strata, weights=changed, minlength=len(strata_w)) / np.maximum(n, 1)
+    delta = np.sum(strata_w * d)
+    se = np.sqrt(np.sum(strata_w**2 * d * (1 - d) / np.maximum(n, 1)))
+    # with no observed change the normal bound is 0, use the rule of three instead
+    return delta, max(delta + z * se, 3.0 / len(changed) if delta == 0 else 0)
+
+
 def get_segment_num(x, y):
     """
     This function is for automatic segmentation of the elbow by two linear lines 
     (given x=no. of clusters, and y=RSS for each clusters)
+    the number of segments (2 or 3) minimizes the ssr of its best fit plus a penalty of y.mean()*0.001 per segment,
+    returned as an array of one element
+    """
+    from utils_elbow import fit_pwl
+    l = y.mean()*0.001
+    f = {n: fit_pwl(x, y, n)[0] + (l*n) for n in [2, 3]}
+    return np.array([min(f, key=f.get)])
+
+def min_distance(x, centers, chunk_size=2**16):
+    """
+    squared euclidean distance of each row of x to its closest center, in float32 and chunk by chunk so that the
+    full n x K distance matrix is never built
+    """
+    centers = np.asarray(centers, dtype=np.float32)
+    centers_sq = np.sum(np.square(centers), axis=1)
+    d2 = np.empty(x.shape[0], dtype=np.float32)
+    for start in range(0, x.shape[0], chunk_size):
+        x_chunk = x[start:start + chunk_size]
+        d = np.sum(np.square(x_chunk), axis=1, keepdims=True) - 2 * (x_chunk @ centers.T) + centers_sq
+        d2[start:start + chunk_size] = np.maximum(d.min(axis=1), 0)
+    return d2
+
+
+def kmeans_sweep(h, Ks, seed=None, restarts=3, chunk_size=2**16):
+    """
+    This function gives the distortion (mean distance of the events to their closest center) for each K in Ks.
+    Instead of independent fits with 20 restarts, the solution of K is grown into the one of K+1: the new center is
+    drawn by greedy k-means++ sampling (probability proportional to the squared distance to the current centers) and
+    k-means is continued from all the centers. A single continuation can stay in the local optimum of K-1 (which
+    moves the elbow), so the lowest potential of it and of a few fresh k-means++ fits of K is kept and grown further.
+    restarts: number of fresh fits of each K (0: the continuation only)
+    """
+    h = np.ascontiguousarray(h, dtype=np.float32)
+    rng = np.random.RandomState(seed)
+    Ks = sorted(Ks)
+    centers = KMeans(n_clusters=Ks[0], n_init=10, random_state=seed).fit(h).cluster_centers_
+    distortions = []
+    for j, k in enumerate(Ks):
+        if j > 0:
+            while centers.shape[0] < k:
+                # greedy k-means++: of a few sampled candidates, keep the one that lowers the potential the most
+                prob = d2.astype(np.float64) / d2.sum(dtype=np.float64)
+                candidates = h[rng.choice(h.shape[0], size=2 + int(np.log(k)), p=prob)]
+                d2_candidates = [np.minimum(d2, min_distance(h, c[None], chunk_size)) for c in candidates]
+                best = int(np.argmin([d.sum(dtype=np.float64) for d in d2_candidates]))
+                centers = np.vstack([centers, candidates[best]])
+                d2 = d2_candidates[best]
+            fit = KMeans(n_clusters=k, init=centers, n_init=1).fit(h)
+            if restarts > 0:
+                fit = min(fit, KMeans(n_clusters=k, n_init=restarts, random_state=rng).fit(h), key=lambda f: f.inertia_)
+            centers = fit.cluster_centers_
+        d2 = min_distance(h, centers, chunk_size)
+        distortions.append(np.mean(np.sqrt(d2)))
+    return np.array(distortions)
+
+
+
+def cluster_num_sample(n, subsampling_frac=1):
     """
-    import pwlf
-    from GPyOpt.methods import BayesianOptimization
-    # initialize piecewise linear fit with your x and y data
-    my_pwlf = pwlf.PiecewiseLinFit(x, y)
-    def my_obj(x):
-        l = y.mean()*0.001
-        f = np.zeros(x.shape[0])
-        for i, j in enumerate(x):
-            my_pwlf.fit(j[0])
-            f[i] = my_pwlf.ssr + (l*j[0])
-        return f
-    # define the lower and upper bound for the number of line segments
-    bounds = [{'name': 'var_1', 'type': 'discrete',
-            'domain': np.arange(2, 4)}]
-    np.random.seed(12121)
-    myBopt = BayesianOptimization(my_obj, domain=bounds, model_type='GP',
-                                initial_design_numdata=3,
-                                initial_design_type='latin',
-                                exact_feval=False, verbosity=False,
-                                verbosity_model=False, num_core=10)
-    max_iter = 50
-
-    # perform the bayesian optimization to find the optimum number
-    # of line segments
-    myBopt.run_optimization(max_iter=max_iter, verbosity=False)
-    return myBopt.x_opt
-
-def get_rss(x, k):
-    """
-    Get Rss for the cluster
-    """
-    from scipy.spatial.distance import cdist
-    kmeanModel = KMeans(n_clusters=k, random_state=None, n_init=20, n_jobs=-1)
-    kmeanModel.fit(x)
-    rss = sum(np.min(cdist(x, 
-          kmeanModel.cluster_centers_, 'euclidean'), axis=1)) / x.shape[0]
-    return rss
-
-
-def get_cluster_num(h, maxK=30, plot_dir=None, i=1, subsampling_frac=1, subsampling_n=0):
+    indices of the events get_cluster_num works on (out of n events), so that only these need to be encoded
+    """
+    index = np.arange(n)
+    if subsampling_frac < 1:
+        np.random.seed(1)
+        index = np.random.randint(0, n, int(subsampling_frac*n))
+    if subsampling_frac > 0:
+        np.random.seed(1)
+        index = index[np.random.randint(0, len(index), 100000)]
+    return index
+
+
+def get_cluster_num(h, maxK=30, plot_dir=None, i=1, subsampling_frac=1, subsampling_n=0, n_jobs=None, sampled=False):
     """
     This function gives the optimal number of cluster given the input h (hidden representation)
     it also can plot out the elbow picture if needed.
     maxK = The highest number of cluster to investigate
     Note: i and subsampling_n are now obsolete, but kept there just to prevent any unintentional bugs when call this funciton
     Note 2: the highest number of events for calculating this is 100k (for practical time purposes)
+    n_jobs: number of threads for the K sweep (all if None)
+    sampled: if True, h holds only the rows of cluster_num_sample and is not subsampled again
     """
     from sklearn.cluster import KMeans, MiniBatchKMeans
     import numpy as np
-    import pwlf
     import matplotlib.pyplot as plt
-    from joblib import Parallel, delayed
+    from utils_elbow import fit_pwl, predict_pwl
+    from threadpoolctl import threadpool_limits
 
-    if subsampling_frac < 1:
-        np.random.seed(1)
-        sampled_index = np.random.randint(0, h.shape[0], int(subsampling_frac*h.shape[0]))
-        h = h[sampled_index, :]
-    if subsampling_frac > 0:
-        np.random.seed(1)
-        sampled_index = np.random.randint(0, h.shape[0], 100000)
-        h = h[sampled_index, :]
-    distortions = []
+    if not sampled:
+        h = h[cluster_num_sample(h.shape[0], subsampling_frac), :]
     Ks = range(5, maxK+1)
-    distortions = Parallel(n_jobs=len(Ks))(delayed(get_rss)(x=h, k=i) for i in Ks)
+    # one warm-started sweep over K (see kmeans_sweep), its BLAS/OpenMP threads are capped to n_jobs
+    with threadpool_limits(limits=n_jobs):
+        distortions = kmeans_sweep(h, Ks, seed=1)
 
     segment_num = get_segment_num(np.array(Ks), np.array(distortions))
-    # fit the data for four line segments
-    my_pwlf = pwlf.PiecewiseLinFit(Ks, distortions)
-    res = my_pwlf.fit(segment_num)
+    # fit the data with the chosen number of line segments, res are the breakpoints
+    _, res, beta = fit_pwl(np.array(Ks), np.array(distortions), int(segment_num[0]))
     print(res[int((segment_num[0]-1))])
     if plot_dir is not None:
         # predict for the determined points
         xHat = np.linspace(min(Ks), max(Ks), num=1000)
-        yHat = my_pwlf.predict(xHat)
+        yHat = predict_pwl(xHat, res, beta)
         plt.figure()
         plt.plot(Ks, distortions, 'o')
         plt.plot(xHat, yHat, '-')